@@ -0,0 +1,14 @@
+"""Synthetic league data and load benchmarks for the ttennis app.
+
+Run from the repository root:
+
+    python -m benchmarks.generate bench.db --players 1000 --results 50000
+    python -m benchmarks.harness --compare benchmarks/baseline.json
+"""
+import os
+import sys
+
+# The app's modules import each other by bare name, as when run from ttennis/
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ttennis")
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
@@ -0,0 +1,137 @@
+"""Fill a copy of tabletennis.db with random players, leagues and results."""
+import argparse
+import datetime
+import os
+import random
+import shutil
+
+from benchmarks import APP_DIR
+
+from database import Database
+from jobs import JobQueue
+from ratings import rebuild_ratings
+from schema import migrate
+from standings import APPLY_RESULTS, REFRESH_FORM, RESULT_COLUMNS, apply_pending, import_matches, refresh_form
+
+# createleague() allows at most this many players in a league
+MAX_LEAGUE_SIZE = 50
+
+
+def random_games(rng):
+    """Return the five (winner, loser) game scores of a random best of 5 match, '' for unplayed games."""
+    lost = rng.randint(0, 2)
+
+    # The winner always takes the last game played
+    order = [True] * 2 + [False] * lost
+    rng.shuffle(order)
+    order.append(True)
+
+    games = []
+    for won in order:
+        if rng.random() < 0.15:
+            winner = rng.randint(12, 16)
+            loser = winner - 2
+        else:
+            winner, loser = 11, rng.randint(0, 9)
+        games.append((winner, loser) if won else (loser, winner))
+
+    return games + [('', '')] * (5 - len(games))
+
+
+def random_match(rng, leagueid, startyear, roster):
+    """Return a valid match between two players of a league, keyed by RESULT_COLUMNS."""
+    player1, player2 = rng.sample(roster, 2)
+    games = random_games(rng)
+
+    # Matches are played over the league's season, September to June
+    date = datetime.date(startyear, 9, 1) + datetime.timedelta(days=rng.randint(0, 300))
+
+    # random_games() is from the winner's side, player 1 wins half the time
+    if rng.random() < 0.5:
+        games = [(p2, p1) for p1, p2 in games]
+    p1sets = sum(1 for p1, p2 in games if p1 != '' and p1 > p2)
+    p2sets = sum(1 for p1, p2 in games if p2 != '' and p2 > p1)
+
+    match = dict(zip(RESULT_COLUMNS, [leagueid, date.isoformat(), player1, player2, p1sets, p2sets]))
+    for g, (p1, p2) in enumerate(games, 1):
+        match["p1g" + str(g)] = p1
+        match["p2g" + str(g)] = p2
+    return match
+
+
+def generate(path, players=500, leagues=20, league_size=20, results=10000, seed=1, batch=1000):
+    """Create a database at path holding random players, leagues and results.
+
+    The database starts as a copy of the app's own so the schema is the one
+    the app runs against. Results go through import_matches() in date order
+    and are applied by draining the job queue, then ratings are replayed in
+    date order across leagues, so every derived table is consistent.
+    Returns the path.
+    """
+    if league_size > MAX_LEAGUE_SIZE:
+        raise ValueError("leagues hold at most {} players".format(MAX_LEAGUE_SIZE))
+    if league_size > players:
+        raise ValueError("not enough players to fill a league")
+
+    rng = random.Random(seed)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    shutil.copyfile(os.path.join(APP_DIR, "tabletennis.db"), path)
+
+    db = Database(path)
+    migrate(db)
+
+    with db.transaction():
+        for table in ["results", "jobs", "league_players", "head_to_head", "player_stats", "rating_history", "players", "leagues"]:
+            db.execute("DELETE FROM {}".format(table))
+        db.execute("DELETE FROM sqlite_sequence WHERE name IN ('results', 'players', 'leagues')")
+
+        names = ["Player {:05d}".format(n) for n in range(1, players + 1)]
+        db.executemany("INSERT INTO players (name, gender, dob) VALUES (?, ?, ?)",
+                       [(name, rng.choice("MF"), "{}-{:02d}-{:02d}".format(rng.randint(1950, 2005), rng.randint(1, 12), rng.randint(1, 28)))
+                        for name in names])
+        ids = {row["name"]: row["id"] for row in db.execute("SELECT id, name FROM players")}
+
+        rosters = []
+        for n in range(1, leagues + 1):
+            startyear = rng.randint(2010, 2020)
+            leagueid = db.execute("INSERT INTO leagues (name, startyear, endyear) VALUES (?, ?, ?)",
+                                  "League {:03d}".format(n), startyear, startyear + 1)
+            roster = rng.sample(names, league_size)
+            db.executemany("INSERT INTO league_players (league_id, player_id) VALUES (?, ?)", [(leagueid, ids[name]) for name in roster])
+            rosters.append((leagueid, startyear, roster))
+
+    matches = [random_match(rng, *rng.choice(rosters)) for n in range(results)]
+    matches.sort(key=lambda match: match["date"])
+
+    jobs = JobQueue(db)
+    jobs.register(APPLY_RESULTS, apply_pending)
+    jobs.register(REFRESH_FORM, refresh_form)
+    for start in range(0, len(matches), batch):
+        errors = import_matches(db, matches[start:start + batch])
+        if errors:
+            raise RuntimeError(errors[0])
+        jobs.drain()
+    rebuild_ratings(db)
+
+    db.close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="database file to create, replaced if it exists")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--leagues", type=int, default=20)
+    parser.add_argument("--league-size", type=int, default=20)
+    parser.add_argument("--results", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    generate(args.path, args.players, args.leagues, args.league_size, args.results, args.seed)
+    print("Wrote {} players, {} leagues and {} results to {}".format(args.players, args.leagues, args.results, args.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Drive the app's routes with the Flask test client and report latency per route."""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks import APP_DIR
+from benchmarks.generate import generate, random_match
+
+
+def leagues_page(rng, rosters):
+    return "GET", "/leagues?league={}".format(rng.choice(rosters)[0]), None
+
+
+def viewresults_league(rng, rosters):
+    return "GET", "/viewresults?league={}".format(rng.choice(rosters)[0]), None
+
+
+def viewresults_all(rng, rosters):
+    return "GET", "/viewresults", None
+
+
+def players_page(rng, rosters):
+    return "GET", "/players", None
+
+
+def players_sorted(rng, rosters):
+    return "POST", "/players", {"filter": rng.choice(["name", "wins", "winratio", "rating"])}
+
+
+def headtohead_page(rng, rosters):
+    return "GET", "/leagues/{}/headtohead".format(rng.choice(rosters)[0]), None
+
+
+def rankings_page(rng, rosters):
+    return "GET", "/?gender={}&year={}&topx=200".format(rng.choice(["male", "female"]), rng.randint(2014, 2020)), None
+
+
+def api_results(rng, rosters):
+    return "GET", "/api/v1/results?limit=100", None
+
+
+def record_form(match):
+    """Return the /recordresults form for a match."""
+    data = {"leaguecarrycarry": match["league_id"], "date": match["date"], "player1carry": match["player1"],
+            "player2carry": match["player2"], "p1set1": match["p1set"], "p2set1": match["p2set"]}
+    for g in range(1, 6):
+        data["p1game" + str(g)] = match["p1g" + str(g)]
+        data["p2game" + str(g)] = match["p2g" + str(g)]
+    return data
+
+
+def recordresults(rng, rosters):
+    # A scorer entering tonight's match, after everything already rated
+    match = random_match(rng, *rng.choice(rosters))
+    match["date"] = datetime.date.today().isoformat()
+    return "POST", "/recordresults", record_form(match)
+
+
+def recordresults_backdated(rng, rosters):
+    # A match from earlier in the season, which has ratings replayed from its date
+    return "POST", "/recordresults", record_form(random_match(rng, *rng.choice(rosters)))
+
+
+# Each scenario picks the next request to make: (method, path, form data)
+SCENARIOS = {
+    "leagues": leagues_page,
+    "viewresults": viewresults_league,
+    "viewresults_all": viewresults_all,
+    "players": players_page,
+    "players_sorted": players_sorted,
+    "headtohead": headtohead_page,
+    "rankings": rankings_page,
+    "api_results": api_results,
+    "recordresults": recordresults,
+    "recordresults_backdated": recordresults_backdated,
+}
+
+
+class QueryCounter:
+    """SQLite trace callback counting the statements run, and noting whether any queued a job."""
+
+    def __init__(self):
+        self.count = 0
+        self.queued = False
+
+    def __call__(self, statement):
+        self.count += 1
+        if statement.startswith("INSERT INTO jobs"):
+            self.queued = True
+
+
+def percentile(timings, p):
+    """Return the p-th percentile of sorted timings by nearest rank."""
+    return timings[max(0, -(-len(timings) * p // 100) - 1)]
+
+
+def load_app(workdir, database):
+    """Import the app inside workdir running against a copy of database."""
+    shutil.copyfile(database, os.path.join(workdir, "tabletennis.db"))
+    os.symlink(os.path.join(APP_DIR, "rankings"), os.path.join(workdir, "rankings"))
+
+    # The app opens its database, rankings and key relative to the working directory
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.chdir(workdir)
+
+    import application
+    application.app.config["TESTING"] = True
+
+    # Jobs run in the measured request below rather than on the worker thread, so their time and queries count
+    application.app.before_request_funcs[None].remove(application.startjobs)
+    return application
+
+
+def run(application, scenario, requests, warmup, rng, rosters, cold):
+    """Make warmup + requests requests for one scenario, returning its summary."""
+    client = application.app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+
+    counter = QueryCounter()
+    application.db.connection.set_trace_callback(counter)
+
+    timings = []
+    queries = 0
+    for n in range(warmup + requests):
+        method, path, data = scenario(rng, rosters)
+        if cold:
+            application.cache.invalidate()
+
+        counter.count = 0
+        counter.queued = False
+        start = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        if counter.queued:
+            application.jobs.drain()
+        elapsed = time.perf_counter() - start
+
+        if response.status_code >= 400:
+            raise RuntimeError("{} {} returned {}".format(method, path, response.status_code))
+
+        if n >= warmup:
+            timings.append(elapsed)
+            queries += counter.count
+
+    application.db.connection.set_trace_callback(None)
+    timings.sort()
+    return {
+        "requests": requests,
+        "p50_ms": round(percentile(timings, 50) * 1000, 3),
+        "p95_ms": round(percentile(timings, 95) * 1000, 3),
+        "p99_ms": round(percentile(timings, 99) * 1000, 3),
+        "queries": round(queries / requests, 2),
+        "throughput": round(requests / sum(timings), 1),
+    }
+
+
+def compare(report, baseline, tolerance):
+    """Print each scenario against the baseline, returning the names that regressed.
+
+    A scenario regresses when its p95 grows by more than tolerance or it
+    runs more queries per request.
+    """
+    regressed = []
+    print("\n{:<16} {:>10} {:>10} {:>8} {:>10} {:>10}".format("vs baseline", "p50", "p95", "change", "queries", "was"))
+    for name, result in report["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(name)
+        if old is None:
+            print("{:<16} {:>10.3f} {:>10.3f} {:>8} {:>10} {:>10}".format(name, result["p50_ms"], result["p95_ms"], "new", result["queries"], "-"))
+            continue
+
+        change = (result["p95_ms"] - old["p95_ms"]) / old["p95_ms"] if old["p95_ms"] else 0
+        print("{:<16} {:>10.3f} {:>10.3f} {:>+7.0%} {:>10} {:>10}".format(name, result["p50_ms"], result["p95_ms"], change, result["queries"], old["queries"]))
+        if change > tolerance or result["queries"] > old["queries"]:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--database", help="benchmark a copy of this database instead of generating one")
+    parser.add_argument("--players", type=int, default=500)
+    parser.add_argument("--leagues", type=int, default=20)
+    parser.add_argument("--league-size", type=int, default=20)
+    parser.add_argument("--results", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=20, help="untimed requests before each scenario")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="run only these scenarios")
+    parser.add_argument("--cold", action="store_true", help="empty the read cache before every request")
+    parser.add_argument("--output", help="write the report as json, e.g. to refresh benchmarks/baseline.json")
+    parser.add_argument("--compare", help="baseline json to diff the report against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="p95 growth allowed before --compare fails")
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="ttennis-bench-")
+    try:
+        database = args.database
+        if database is None:
+            database = generate(os.path.join(workdir, "generated.db"), args.players, args.leagues, args.league_size, args.results, args.seed)
+        database = os.path.abspath(database)
+
+        application = load_app(workdir, database)
+
+        rosters = [(league["id"], league["startyear"], [row["playername"] for row in application.league_roster(application.db, league["id"])])
+                   for league in application.all_leagues(application.db)]
+        rosters = [roster for roster in rosters if len(roster[2]) >= 2]
+        if not rosters:
+            raise SystemExit("the database needs a league with at least two players")
+
+        rng = random.Random(args.seed)
+        report = {
+            "config": {"players": args.players, "leagues": args.leagues, "league_size": args.league_size, "results": args.results,
+                       "requests": args.requests, "warmup": args.warmup, "cold": args.cold, "database": args.database},
+            "python": platform.python_version(),
+            "scenarios": {},
+        }
+
+        print("{:<16} {:>10} {:>10} {:>10} {:>10} {:>10}".format("scenario", "p50 ms", "p95 ms", "p99 ms", "queries", "req/s"))
+        for name in args.scenario or SCENARIOS:
+            result = run(application, SCENARIOS[name], args.requests, args.warmup, rng, rosters, args.cold)
+            report["scenarios"][name] = result
+            print("{:<16} {:>10.3f} {:>10.3f} {:>10.3f} {:>10} {:>10}".format(
+                name, result["p50_ms"], result["p95_ms"], result["p99_ms"], result["queries"], result["throughput"]))
+
+        application.db.close()
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressed = compare(report, json.load(file), args.tolerance)
+        if regressed:
+            print("\nRegressed: " + ", ".join(regressed), file=sys.stderr)
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
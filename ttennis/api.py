@@ -0,0 +1,200 @@
+import json
+
+from flask import Blueprint, Response, jsonify, request, session, stream_with_context
+
+from queries import all_leagues, find_league, league_head_to_head, league_table, player_stats
+from results import iter_results, parse_cursor, results_page
+
+
+class ApiError(Exception):
+    """Bad request to the API, reported to the client as json."""
+
+    def __init__(self, message, code=400):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+def fields_param():
+    """Return the fields asked for with ?fields=a,b or None for every field."""
+    if not request.args.get("fields"):
+        return None
+    return [field.strip() for field in request.args.get("fields").split(",") if field.strip()]
+
+
+def limit_param():
+    """Return ?limit= as a positive int, or None to stream the whole collection."""
+    if not request.args.get("limit"):
+        return None
+    try:
+        limit = int(request.args.get("limit"))
+    except ValueError:
+        raise ApiError("limit must be a whole number")
+    if limit < 1:
+        raise ApiError("limit must be at least 1")
+    return limit
+
+
+def project(row, fields):
+    """Keep only the requested fields of a row."""
+    if fields is None:
+        return row
+    missing = [field for field in fields if field not in row]
+    if missing:
+        raise ApiError("unknown field: " + ", ".join(missing))
+    return {field: row[field] for field in fields}
+
+
+def ndjson(rows, fields, cursor=None):
+    """Stream rows as newline delimited json, one object per line.
+
+    rows may be a generator so large collections are never built in memory.
+    When there are more rows the next cursor is sent in the X-Next-Cursor header.
+    """
+    rows = iter(rows)
+
+    # Pull the first row now so a bad fields= is reported before streaming starts
+    first = next(rows, None)
+    if first is not None:
+        first = project(first, fields)
+
+    def generate():
+        if first is None:
+            return
+        yield json.dumps(first) + "\n"
+        for row in rows:
+            yield json.dumps(project(row, fields)) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    if cursor is not None:
+        response.headers["X-Next-Cursor"] = str(cursor)
+    return response
+
+
+def create_api(db, rankings):
+    """Build the /api/v1 blueprint over the app's database and rankings store."""
+    api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+    @api.errorhandler(ApiError)
+    def api_error(e):
+        return jsonify(error=e.message), e.code
+
+    @api.before_request
+    def require_login():
+        """Refuse every endpoint with a json 401 unless logged in, rather than redirect to the login page"""
+        if session.get("user_id") is None:
+            raise ApiError("login required", 401)
+
+    @api.route("/rankings/<int:year>/<gender>")
+    def rankings_list(year, gender):
+        """Stream one rankings file in rank order, the cursor is a row offset"""
+        season = rankings.get(year, gender, request.args.get("period") or None)
+        if season is None:
+            raise ApiError("no rankings for that year", 404)
+
+        cursor = request.args.get("cursor", "0")
+        if not cursor.isdigit():
+            raise ApiError("invalid cursor")
+        start = int(cursor)
+
+        limit = limit_param()
+        stop = len(season) if limit is None else start + limit
+        rows = season.slice(start, stop)
+
+        following = stop if stop < len(season) else None
+        return ndjson((row._asdict() for row in rows), fields_param(), following)
+
+    @api.route("/rankings/players/<int:ittfid>")
+    def rankings_player(ittfid):
+        """Return one ITTF player's ranking in every season, oldest first"""
+        career = rankings.career(ittfid)
+        if not career:
+            raise ApiError("no rankings for that player", 404)
+
+        fields = fields_param()
+        return jsonify(id=ittfid, name=career[-1].ranking.name, assoc=career[-1].ranking.assoc,
+                       seasons=[project(dict(entry.ranking._asdict(), year=entry.year, period=entry.period, gender=entry.gender), fields) for entry in career])
+
+    @api.route("/leagues")
+    def leagues_list():
+        """Stream every league"""
+        return ndjson(all_leagues(db), fields_param())
+
+    @api.route("/leagues/<int:leagueid>")
+    def league_detail(leagueid):
+        """Return one league"""
+        league = find_league(db, leagueid)
+        if not league:
+            raise ApiError("league does not exist", 404)
+        return jsonify(project(league[0], fields_param()))
+
+    @api.route("/leagues/<int:leagueid>/standings")
+    def league_standings(leagueid):
+        """Stream a league table in points order"""
+        if not find_league(db, leagueid):
+            raise ApiError("league does not exist", 404)
+        return ndjson(league_table(db, leagueid), fields_param())
+
+    @api.route("/leagues/<int:leagueid>/headtohead")
+    def league_headtohead(leagueid):
+        """Stream every pair's record in a league, once from each player's side"""
+        if not find_league(db, leagueid):
+            raise ApiError("league does not exist", 404)
+        return ndjson(league_head_to_head(db, leagueid).values(), fields_param())
+
+    @api.route("/leagues/<int:leagueid>/headtohead/<int:playerid>/<int:opponentid>")
+    def league_pair(leagueid, playerid, opponentid):
+        """Return one player's record against another in a league"""
+        if not find_league(db, leagueid):
+            raise ApiError("league does not exist", 404)
+
+        record = league_head_to_head(db, leagueid).get((playerid, opponentid))
+        if record is None:
+            raise ApiError("these players have not played each other in this league", 404)
+        return jsonify(project(record, fields_param()))
+
+    @api.route("/players")
+    def players_list():
+        """Stream players in id order, the cursor is the last id seen"""
+        cursor = request.args.get("cursor", "0")
+        if not cursor.isdigit():
+            raise ApiError("invalid cursor")
+
+        limit = limit_param()
+        if limit is None:
+            return ndjson(db.iterate("SELECT * FROM players WHERE id > ? ORDER BY id", int(cursor)), fields_param())
+
+        # Fetch one extra row to find out whether another page follows
+        players = db.execute("SELECT * FROM players WHERE id > ? ORDER BY id LIMIT ?", int(cursor), limit + 1)
+        following = players[limit - 1]["id"] if len(players) > limit else None
+        return ndjson(players[:limit], fields_param(), following)
+
+    @api.route("/players/<int:playerid>")
+    def player_detail(playerid):
+        """Return one player with their stats across every league"""
+        stats = player_stats(db, playerid)
+        if stats is None:
+            raise ApiError("no such player", 404)
+        return jsonify(project(stats, fields_param()))
+
+    @api.route("/results")
+    def results_list():
+        """Stream results newest first, optionally for one ?league=, the cursor is date_id"""
+        leagueid = request.args.get("league")
+        if leagueid is not None and not find_league(db, leagueid):
+            raise ApiError("league does not exist", 404)
+
+        before = None
+        if request.args.get("cursor"):
+            before = parse_cursor(request.args.get("cursor"))
+            if before is None:
+                raise ApiError("invalid cursor")
+
+        limit = limit_param()
+        if limit is None:
+            return ndjson(iter_results(db, leagueid, before), fields_param())
+
+        results, newer, older = results_page(db, leagueid, before, None, limit)
+        return ndjson(results, fields_param(), older)
+
+    return api
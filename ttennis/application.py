@@ -1,15 +1,28 @@
 import os
-import csv
 import datetime
+import hashlib
+import hmac
+import time
 
-from cs50 import SQL
-from flask import Flask, flash, jsonify, redirect, render_template, request, session
-from flask_session import Session
-from tempfile import mkdtemp
+import click
+
+from flask import Flask, Response, flash, jsonify, redirect, render_template, request, session, stream_with_context, url_for
 from werkzeug.exceptions import default_exceptions, HTTPException, InternalServerError
-from werkzeug.security import check_password_hash, generate_password_hash
 
-from helpers import apology, login_required, usd
+from api import create_api
+from database import Database
+from helpers import apology, conditional, login_required, secret_key, usd
+from jobs import JobQueue
+from live import Broadcaster, publish_results, watched_tables
+from metrics import Metrics
+from passwords import ITERATIONS, METHOD, WORKERS, Passwords, PasswordsBusy
+from queries import PLAYER_ORDERS, all_leagues, all_players, cache, find_league, league_created, league_head_to_head, league_roster, league_table, page_version, players_changed, player_stats, result_events, results_recorded, search_players
+from rankings import RankingsStore, ingest_rankings
+from ratings import rebuild_ratings, replay_ratings
+from results import parse_cursor, results_page
+from schema import migrate
+from snapshot import SNAPSHOT_FILE, read_snapshot, write_snapshot
+from standings import APPLY_RESULTS, FAILED, LEAGUE_COUNTERS, PLAYER_COUNTERS, REBUILD_RATINGS, REFRESH_FORM, apply_pending, edit_result, game_score, import_matches, read_matches, rebuild_standings, record_match, refresh_form, refresh_stats, validate_match, void_result
 
 # Configure application
 app = Flask(__name__)
@@ -17,9 +30,11 @@ app = Flask(__name__)
 # Ensure templates are auto-reloaded
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
-# Ensure responses aren't cached
+# Ensure responses aren't cached, unless a route has set its own policy
 @app.after_request
 def after_request(response):
+    if "Cache-Control" in response.headers:
+        return response
     response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
     response.headers["Expires"] = 0
     response.headers["Pragma"] = "no-cache"
@@ -28,70 +43,198 @@ def after_request(response):
 # Custom filter
 app.jinja_env.filters["usd"] = usd
 
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_FILE_DIR"] = mkdtemp()
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+# Sessions only hold user_id so keep them in signed cookies, shared by every worker
+app.secret_key = secret_key("secret_key")
+app.config["PERMANENT_SESSION_LIFETIME"] = datetime.timedelta(days=7)
+app.config["SESSION_COOKIE_HTTPONLY"] = True
+app.config["SESSION_COOKIE_SAMESITE"] = "Lax"
+
+# Only send the cookie when the session changes, it expires a week after login
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+
+# Password hashing runs in a pool of processes, PASSWORD_METHOD and PASSWORD_ITERATIONS set the work factor
+passwords = Passwords(method=os.environ.get("PASSWORD_METHOD", METHOD), iterations=int(os.environ.get("PASSWORD_ITERATIONS", ITERATIONS)),
+                      workers=int(os.environ.get("PASSWORD_WORKERS", WORKERS)))
+
+# Configure database access, one SQLite connection per worker thread
+db = Database("tabletennis.db")
+migrate(db)
+
+# Per route query counts and timings, SLOW_REQUEST_MS logs slower requests with their SQL
+metrics = Metrics(slow_ms=int(os.environ.get("SLOW_REQUEST_MS", 0)))
+metrics.init_app(app, db)
+
+# Bearer token scrapers send for /metrics, which is refused to everyone while it is unset
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Load the ITTF rankings once rather than per search, from the compiled snapshot where it is current
+rankings = RankingsStore()
+rankings.load_all(read_snapshot(SNAPSHOT_FILE))
+
+# Seconds browsers may reuse a rankings page for a named period without checking back
+RANKINGS_MAX_AGE = 86400
+
+# Rankings rows shown per page, enough for the largest top x search
+RANKINGS_PAGE_SIZE = 200
+
+# Pushes new results to anyone watching a league, within this process
+broadcaster = Broadcaster()
+
+# Recorded results are applied to standings, head to head, stats and ratings by a background worker
+jobs = JobQueue(db)
+
+
+def apply_league_results(db, leagueid):
+    """Apply a league's new results, keeping its standings from before for live viewers"""
+    before = watched_tables(broadcaster, db, [leagueid])
+    return before, apply_pending(db, leagueid)
+
+
+def league_results_applied(leagueid, applied):
+    """Drop cached pages for the league and push the changes to anyone watching it"""
+    before, results = applied
+    results_recorded([leagueid])
+    publish_results(broadcaster, db, before, results)
+
+
+jobs.register(APPLY_RESULTS, apply_league_results, after=league_results_applied)
+
+
+def rebuild_ratings_job(db, key):
+    """Replay results from the date of one edited or voided, since ratings depend on their order"""
+    # Jobs queued before replays began from a date rebuild everything
+    if key == "all":
+        return rebuild_ratings(db)
+    return replay_ratings(db, key)
+
 
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///tabletennis.db")
+def ratings_rebuilt(key, replayed):
+    """Drop cached player lists, which are sorted and shown with ratings"""
+    players_changed()
+
+
+jobs.register(REFRESH_FORM, refresh_form)
+jobs.register(REBUILD_RATINGS, rebuild_ratings_job, after=ratings_rebuilt)
+
+
+@app.before_request
+def startjobs():
+    """Start the worker in each serving process, it first runs jobs left from before a restart"""
+    jobs.start()
+
+# JSON version of the same data for scoreboards and mobile clients
+app.register_blueprint(create_api(db, rankings))
 
 
 @app.route("/", methods=["GET", "POST"])
 @login_required
 def index():
     """Show homepage with power rankings"""
-    if request.method == "POST":
 
-        if not request.form.get('topx'):
+    # Searches arrive as GET parameters so they can be cached, POST is still accepted
+    search = request.form if request.method == "POST" else request.args
+
+    if request.method == "POST" or search:
+
+        # Name, association and points filters can be used with or instead of top x
+        name = search.get("name", "").strip()
+        assoc = search.get("assoc", "").strip()
+        try:
+            minpoints = int(search.get("minpoints")) if search.get("minpoints") else None
+            maxpoints = int(search.get("maxpoints")) if search.get("maxpoints") else None
+            page = int(search.get("page", 1))
+        except ValueError:
+            return apology("points and page must be whole numbers", 403)
+
+        filtered = bool(name or assoc or minpoints is not None or maxpoints is not None)
+
+        if not search.get('topx') and not filtered:
             return apology("must specify top x players", 403)
 
-        # Variable for top x players
-        w = int(request.form.get("topx"))
+        # Variable for top x players, 0 meaning every player matching the filters
+        try:
+            w = int(search.get("topx")) if search.get("topx") else 0
+        except ValueError:
+            return apology("must specify top x players", 403)
+
+        # Variables for gender and year used to look up the rankings
+        gender = str(search.get("gender"))
+        year = str(search.get("year"))
 
-        # Variables for gender and year to be used for csv file and a dictionary for later
-        gender = str(request.form.get("gender"))
-        year = str(request.form.get("year"))
-        rank_dict = []
         # Ensure user's search is valid
-        if not request.form.get("gender"):
+        if not search.get("gender"):
             return apology("must provide a gender", 403)
 
-        if not request.form.get("year"):
+        if not search.get("year"):
             return apology("must provide a year", 403)
 
-        elif w < 1:
+        elif w < 0 or (w == 0 and not filtered):
             return apology("must search for at least one player", 403)
 
         elif w > 200:
             return apology("max search = 200", 403)
 
-        csv_name = "rankings/" + year + gender + ".csv"
+        # The year's latest rankings unless an earlier week or month is asked for
+        season = rankings.get(year, gender, search.get("period") or None)
+
+        if season is None:
+            return apology("no rankings for that year", 403)
+
+        if page < 1:
+            return apology("no such page", 403)
+
+        # Matching rows come from the season's indexes, in rank order
+        rows = season.search(name, assoc, minpoints, maxpoints)
+        if w:
+            rows = rows[:w]
 
-        # Open up the relevant csv file and copy data into a dict object
-        with open(csv_name, newline='') as rankingcsv:
-            rankinglist = csv.DictReader(rankingcsv)
+        # Only the rows on this page are built
+        total = len(rows)
+        start = (page - 1) * RANKINGS_PAGE_SIZE
+        rank_dict = [season.row(i) for i in rows[start:start + RANKINGS_PAGE_SIZE]]
 
-            for row in rankinglist:
-                rank_dict.append(row)
+        # Links to neighbouring pages keep the rest of the search
+        args = {key: value for key, value in search.items() if key != "page"}
+        newer = url_for("index", page=page - 1, **args) if page > 1 else None
+        older = url_for("index", page=page + 1, **args) if start + RANKINGS_PAGE_SIZE < total else None
 
         y = 0
 
         # Include other variables for search function
-        x = [2014, 2015, 2016, 2017, 2018, 2019, 2020]
+        x = rankings.years()
         z = len(x)
+        period = season.period
 
-        return render_template("indexsearch.html", rank_dict=rank_dict, y=y, x=x, z=z, w=w, year=year, gender=gender)
+        # A period's file rarely changes so browsers may keep its page for a day, but a search for a
+        # year's latest period must check back, as ingesting a newer period changes what it shows
+        search_tag = hashlib.sha1(request.query_string).hexdigest()[:16]
+        max_age = RANKINGS_MAX_AGE if search.get("period") else 0
+        return conditional("rankings-{}-{}".format(season.etag, search_tag), max_age,
+                           lambda: render_template("indexsearch.html", rank_dict=rank_dict, y=y, x=x, z=z, w=w, year=year, period=period, gender=gender,
+                                                   search=search, filtered=filtered, total=total, newer=newer, older=older))
 
     else:
-        # For now just offering data for the following years
-        x = [2014, 2015, 2016, 2017, 2018, 2019, 2020]
+        # Every year in the rankings folder, including periods ingested since startup
+        x = rankings.years()
         y = 0
         z = len(x)
         return render_template("index.html", x=x, y=y, z=z)
 
 
+@app.route("/rankings/player/<int:ittfid>")
+@login_required
+def rankingsplayer(ittfid):
+    """Show one ITTF player's ranking in every season"""
+    career = rankings.career(ittfid)
+
+    if not career:
+        return apology("no rankings for that player", 404)
+
+    # Latest season has the current name and association
+    player = career[-1].ranking
+    return render_template("rankingsplayer.html", player=player, career=career)
+
+
 @app.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
@@ -110,16 +253,28 @@ def login():
         elif not request.form.get("password"):
             return apology("must provide password", 403)
 
+        # Refuse usernames with too many recent failures before doing any hashing
+        username = request.form.get("username")
+        if passwords.throttled(username):
+            return apology("too many attempts, try again later", 429)
+
         # Query database for username
         rows = db.execute("SELECT * FROM users WHERE username = :username",
-                          username=request.form.get("username"))
+                          username=username)
 
         # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(rows[0]["hash"], request.form.get("password")):
+        if len(rows) != 1 or not passwords.verify(rows[0]["hash"], request.form.get("password")):
+            passwords.failed(username)
             return apology("invalid username and/or password", 403)
+        passwords.succeeded(username)
 
-        # Remember which user has logged in
+        # Hashes made with an older method or fewer iterations are upgraded while the password is to hand
+        if passwords.needs_rehash(rows[0]["hash"]):
+            db.execute("UPDATE users SET hash = ? WHERE id = ?", passwords.hash(request.form.get("password")), rows[0]["id"])
+
+        # Remember which user has logged in, until the session lifetime runs out
         session["user_id"] = rows[0]["id"]
+        session.permanent = True
 
         # Redirect user to home page
         return redirect("/")
@@ -183,7 +338,7 @@ def register():
 
         # Create variables for username and password and insert this into db
         username = request.form.get("username")
-        passx = generate_password_hash(password)
+        passx = passwords.hash(password)
         db.execute("INSERT INTO users (username, hash) VALUES (?, ?)", username, passx)
 
         # Return user to root
@@ -200,10 +355,15 @@ def change():
     """Allow user to change password"""
     if request.method == "POST":
 
-        # Check the current password is correct
+        # Check the current password is correct, with the same throttling as logging in
         rows = db.execute("SELECT * FROM users WHERE id = :id", id=session["user_id"])
-        if not check_password_hash(rows[0]['hash'], request.form.get("password")):
+        if passwords.throttled(rows[0]["username"]):
+            return apology("too many attempts, try again later", 429)
+
+        if not passwords.verify(rows[0]['hash'], request.form.get("password")):
+            passwords.failed(rows[0]["username"])
             return apology("password entered is incorrect", 403)
+        passwords.succeeded(rows[0]["username"])
 
         # Validate against null value
         if not request.form.get("newpassword"):
@@ -217,7 +377,7 @@ def change():
             return apology("passwords do not match", 403)
 
         # Having passed through validation the password must be updated
-        passx = generate_password_hash(request.form.get("newpassword"))
+        passx = passwords.hash(request.form.get("newpassword"))
         db.execute("UPDATE users SET hash = ? WHERE id = ?", passx, session["user_id"])
         flash("Password changed successfully")
         return redirect("/")
@@ -235,27 +395,44 @@ def players():
         # Get the variable to order by
        filter = str(request.form.get("filter"))
 
-       # Different order if filtering by names
-       if filter == "name":
-           players = db.execute("SELECT * FROM players ORDER BY {} ASC".format(filter))
-           y = 0
-           x = len(players)
-           return render_template("players.html", x=x, players=players, y=y)
+       if filter not in PLAYER_ORDERS:
+           return apology("must select an order", 403)
 
-       else:
-           players = db.execute("SELECT * FROM players ORDER BY {} DESC".format(filter))
-           y = 0
-           x = len(players)
-           return render_template("players.html", x=x, players=players, y=y)
+       # Names sort ascending, all other columns descending
+       players = all_players(db, filter)
+       y = 0
+       x = len(players)
+       return render_template("players.html", x=x, players=players, y=y)
 
     else:
 
         # Return a table with all entries in the players table
-        players = db.execute("SELECT * FROM players")
+        players = all_players(db)
         y = 0
         x = len(players)
         return render_template("players.html", x=x, players=players, y=y)
 
+@app.route("/players/<int:playerid>")
+@login_required
+def playerstats(playerid):
+    """Show one player's record, scoring and form across every league"""
+    stats = player_stats(db, playerid)
+    if stats is None:
+        return apology("no such player", 404)
+    return render_template("playerstats.html", stats=stats)
+
+@app.route("/players/search")
+@login_required
+def playersearch():
+    """Return the names of players starting with ?q= for the player pickers, optionally in one ?league="""
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), 50)
+    except ValueError:
+        return jsonify(error="limit must be a whole number"), 400
+
+    leagueid = request.args.get("league") or None
+    return jsonify(search_players(db, request.args.get("q", "").strip(), limit, leagueid))
+
 @app.route("/createplayers", methods=["GET", "POST"])
 @login_required
 def createplayers():
@@ -290,6 +467,7 @@ def createplayers():
         dob = request.form.get("dob")
 
         db.execute("INSERT INTO players (name, gender, dob) VALUES (?, ?, ?)", name, gender, dob)
+        players_changed()
         flash("Player created successfully")
         return render_template("createplayers.html")
 
@@ -301,36 +479,95 @@ def createplayers():
 def leagues():
     """Allow user select and view leagues and a link to create new"""
 
+    # League comes from the select form as a GET parameter, POST is still accepted
     if request.method == "POST":
-
-        # Get the name and years for this league
         l = request.form.get('league')
-        leaguetitle = db.execute("SELECT * FROM leagues WHERE id = :id", id=l)
+    else:
+        l = request.args.get('league')
 
-        # Same code as GET to populate search
-        leagues = db.execute("SELECT * FROM leagues")
-        y = 0
-        x = len(leagues)
+    if request.method == "POST" or l:
 
         # Validate to ensure correct usages
-        if not request.form.get("league"):
+        if not l:
             return apology("must select league", 403)
 
-        # Find the relevant table for that particular league and return it
-        leagues1 = '"' + str(request.form.get('league')) + '"'
-        leaguetable = db.execute("SELECT * FROM {} ORDER BY points DESC, pd DESC, playername".format(leagues1))
+        # Get the name and years for this league
+        leaguetitle = find_league(db, l)
+        if not leaguetitle:
+            return apology("league does not exist", 403)
 
-        z = 0
-        w = len(leaguetable)
+        # Same code as GET to populate search
+        leagues = all_leagues(db)
+        y = 0
+        x = len(leagues)
 
-        return render_template('leaguessearch.html', x=x, y=y, leaguetable=leaguetable, leaguetitle=leaguetitle, z=z, w=w, leagues=leagues)
+        def render():
+            # Find the standings for that particular league and return them
+            leaguetable = league_table(db, l)
+            z = 0
+            w = len(leaguetable)
+            return render_template('leaguessearch.html', x=x, y=y, leaguetable=leaguetable, leaguetitle=leaguetitle, z=z, w=w, leagues=leagues)
+
+        # The table only changes when a result is recorded in this league
+        return conditional("league-" + page_version(db, leaguetitle[0]["id"]), 0, render)
 
     else:
-        leagues = db.execute("SELECT * FROM leagues")
+        leagues = all_leagues(db)
         y = 0
         x = len(leagues)
         return render_template("leagues.html", leagues=leagues, y=y, x=x)
 
+
+@app.route("/leagues/<int:leagueid>/headtohead")
+@login_required
+def headtohead(leagueid):
+    """Show every player's record against every other player in a league"""
+    leaguetitle = find_league(db, leagueid)
+    if not leaguetitle:
+        return apology("league does not exist", 403)
+
+    def render():
+        # Rows and columns both follow the league table
+        leaguetable = league_table(db, leagueid)
+        matrix = league_head_to_head(db, leagueid)
+        return render_template("headtohead.html", leaguetable=leaguetable, leaguetitle=leaguetitle, matrix=matrix)
+
+    return conditional("headtohead-" + page_version(db, leagueid), 0, render)
+
+
+@app.route("/leagues/<int:leagueid>/headtohead/<int:playerid>/<int:opponentid>")
+@login_required
+def rivalry(leagueid, playerid, opponentid):
+    """Show two players' record against each other and the matches between them"""
+    leaguetitle = find_league(db, leagueid)
+    if not leaguetitle:
+        return apology("league does not exist", 403)
+
+    names = {row["player_id"]: row["playername"] for row in league_table(db, leagueid)}
+    if playerid not in names or opponentid not in names or playerid == opponentid:
+        return apology("players must be two different players in the league", 403)
+
+    def render():
+        record = league_head_to_head(db, leagueid).get((playerid, opponentid))
+        player, opponent = names[playerid], names[opponentid]
+        results = db.execute("SELECT * FROM results WHERE league_id = ? AND ((player1 = ? AND player2 = ?) OR (player1 = ? AND player2 = ?)) "
+                             "ORDER BY date DESC, id DESC", leagueid, player, opponent, opponent, player)
+        return render_template("rivalry.html", leaguetitle=leaguetitle, player=player, opponent=opponent, record=record, results=results)
+
+    return conditional("rivalry-{}-{}-".format(playerid, opponentid) + page_version(db, leagueid), 0, render)
+
+@app.route("/leagues/<int:leagueid>/stream")
+@login_required
+def leaguestream(leagueid):
+    """Stream a league's new results and changed standings as Server-Sent Events"""
+    if not find_league(db, leagueid):
+        return apology("league does not exist", 403)
+
+    response = Response(stream_with_context(broadcaster.listen(str(leagueid))), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
 @app.route("/createleague", methods=["GET", "POST"])
 @login_required
 def createleague():
@@ -370,21 +607,23 @@ def createleague():
 
                 allplayers.append(request.form.get(name))
 
+            # Names are typed with suggestions rather than picked from a list, so check they exist
+            known = db.execute("SELECT COUNT(*) AS n FROM players WHERE name IN ({})".format(", ".join("?" * len(allplayers))), *allplayers)
+            if known[0]["n"] != len(allplayers):
+                return apology("no player with that name", 403)
+
             # With all validation passed need to add information to leagues table
             name = str(request.form.get("name"))
             startyear = int(request.form.get("startyear"))
             endyear = int(request.form.get("endyear"))
 
-            db.execute("INSERT INTO leagues (name, startyear, endyear) VALUES (?, ?, ?)", name, startyear, endyear)
+            with db.transaction():
+                id = db.execute("INSERT INTO leagues (name, startyear, endyear) VALUES (?, ?, ?)", name, startyear, endyear)
 
-            # Create a new table using the id key of the new league
-            id1 = db.execute("SELECT id FROM leagues WHERE name= :name", name=name)
-            id = "'" + str(id1[0]['id']) + "'"
-            db.execute("CREATE TABLE {} ('id' INTEGER PRIMARY KEY, 'playername' varchar(245) NOT NULL, 'gamesplayed' int NOT NULL DEFAULT 0, 'gameswon' int NOT NULL DEFAULT 0, 'gameslost' int NOT NULL DEFAULT 0, 'pf' int NOT NULL DEFAULT 0, 'pa' int NOT NULL DEFAULT 0, 'pd' int NOT NULL DEFAULT 0, 'points' int NOT NULL DEFAULT 0)".format(id))
-
-            # Insert a row for each player into this table
-            for y in range(x):
-                db.execute("INSERT INTO {} (playername) VALUES(?)".format(id), allplayers[y])
+                # Insert a standings row for each player in the new league
+                db.executemany("INSERT INTO league_players (league_id, player_id) SELECT ?, id FROM players WHERE name = ?",
+                               [(id, player) for player in allplayers])
+            league_created()
 
             # Flash message and return html
             flash("League created successfully")
@@ -393,18 +632,16 @@ def createleague():
         # If the form submitted just contains the number of players
         else:
             nplayers = int(request.form.get("playersnumber"))
-            players = db.execute("SELECT name FROM players")
 
             if nplayers > 50 or nplayers < 2:
                 return apology("players in league must be between 2 and 50", 403)
 
-            if nplayers > len(players):
+            if nplayers > db.execute("SELECT COUNT(*) AS n FROM players")[0]["n"]:
                 return apology("not enough players available to fulfill request", 403)
 
+            # Player names are suggested as they are typed, so the page does not list every player
             y = 0
-            z = 0
-            x = len(players)
-            return render_template("createleague2.html", nplayers=nplayers, x=x, y=y, players=players, z=z)
+            return render_template("createleague2.html", nplayers=nplayers, y=y)
 
     else:
         return render_template('createleague.html')
@@ -421,16 +658,13 @@ def recordresults():
 
             # Get the list of possible players using the league id provided
             leagueid = request.form.get("league")
-            leaguename = db.execute("SELECT * FROM leagues WHERE id= :id", id=leagueid)
+            leaguename = find_league(db, leagueid)
 
-            # Use this version for SQL query
-            leagueid1 = '"' + str(leagueid) + '"'
-            players = db.execute("SELECT playername FROM {}".format(leagueid1))
+            if not leaguename:
+                return apology("league does not exist", 403)
 
-            y = 0
-            x = len(players)
-
-            return render_template("recordresults1.html", players=players, y=y, x=x, leaguename=leaguename, leagueid=leagueid)
+            # Players are suggested from the league as they are typed
+            return render_template("recordresults1.html", leaguename=leaguename, leagueid=leagueid)
 
         # Following three cases ensure that player names are provided
         if request.form.get('leaguecarry') and request.form.get('player1') and not request.form.get('player2'):
@@ -449,269 +683,340 @@ def recordresults():
                 return apology("cannot play a match with one player", 403)
 
             leagueid = request.form.get("leaguecarry")
-            leaguename = db.execute("SELECT * FROM leagues WHERE id= :id", id=leagueid)
+            leaguename = find_league(db, leagueid)
             player1 = request.form.get('player1')
             player2 = request.form.get('player2')
 
-            return render_template("recordresults2.html", leagueid=leagueid, leaguename=leaguename, player1=player1, player2=player2)
-
-        # Score submitted- case for when not enough sets played
-        if request.form.get('leaguecarrycarry') and (int(request.form.get('p1set1')) != 3 and int(request.form.get('p2set1')) != 3):
-            return apology("matches must be best of 5 sets", 403)
+            roster = {row["playername"] for row in league_roster(db, leagueid)}
+            if player1 not in roster or player2 not in roster:
+                return apology("both players must be in the league", 403)
 
-        # Case for when sets entered correctly but not enough games
-        if request.form.get('leaguecarrycarry') and int(request.form.get('p1game3')) == 0 and int(request.form.get('p2game3')) == 0:
-            return apology("matches must be best of 5 sets", 403)
-
-        if request.form.get('leaguecarrycarry') and (int(request.form.get('p1set1')) < 0 or int(request.form.get('p2set1')) < 0):
-            return apology('cannot record negative set number', 403)
-
-        # Case for scores being equal
-        if request.form.get('leaguecarrycarry') and request.form.get('p1set1') == request.form.get('p2set1'):
-            return apology('game must have a winner', 403)
-
-        # Case for no date provided
-        if request.form.get('leaguecarrycarry') and not request.form.get('date'):
-            return apology('no date provided', 403)
-
-        # If validation passes update players table with new data
-
-        # If player 1 was the winner
-        if request.form.get('p1set1') > request.form.get('p2set1'):
-            name = str(request.form.get('player1carry'))
-            playerstats = db.execute("SELECT * FROM players WHERE name= :name", name=name)
-
-            # Create variable with values for games, wins + 1
-            games = int(playerstats[0]['games']) + 1
-            wins =  int(playerstats[0]['wins']) + 1
-
-            # Update the table
-            db.execute("UPDATE players SET games = ?, wins = ? WHERE name=?", games, wins, name)
-
-            # Update the ratio columns for both players
-            ratio = db.execute("SELECT * FROM players WHERE name= :name", name=name)
-
-            if ratio[0]['wins'] == 0 and ratio[0]['losses'] == 0:
-                db.execute("UPDATE players SET winratio=0 WHERE name= :name", name=name)
-
-            elif ratio[0]['wins'] == 0 and ratio[0]['losses'] > 0:
-                db.execute("UPDATE players SET winratio=0 WHERE name= :name", name=name)
-
-            elif ratio[0]['wins'] > 0 and ratio[0]['losses'] == 0:
-                db.execute("UPDATE players SET winratio=1 WHERE name= :name", name=name)
-
-            # Case where the ratio needs to be calculated
-            else:
-                new_ratio = round(float(ratio[0]['wins'] / (ratio[0]['wins'] + ratio[0]['losses'])), 2)
-                db.execute("UPDATE players SET winratio=? WHERE name=?", new_ratio, name)
-
-            # Same thing for player 2
-            name2 = str(request.form.get('player2carry'))
-            playerstats2 = db.execute("SELECT * FROM players WHERE name= :name2", name2=name2)
-
-            games2 = int(playerstats2[0]['games']) + 1
-            losses =  int(playerstats2[0]['losses']) + 1
-            db.execute("UPDATE players SET games = ?, losses = ? WHERE name=?", games2, losses, name2)
-
-            # Work out new ratio
-            ratio2 = db.execute("SELECT * FROM players WHERE name= :name2", name2=name2)
-
-            if ratio2[0]['wins'] == 0 and ratio2[0]['losses'] == 0:
-                db.execute("UPDATE players SET winratio=0 WHERE name= :name2", name2=name2)
-
-            elif ratio2[0]['wins'] == 0 and ratio2[0]['losses'] > 0:
-                db.execute("UPDATE players SET winratio=0 WHERE name= :name2", name2=name2)
-
-            elif ratio2[0]['wins'] > 0 and ratio2[0]['losses'] == 0:
-                db.execute("UPDATE players SET winratio=1 WHERE name= :name2", name2=name2)
-
-            else:
-                new_ratio2 = round(float(ratio2[0]['wins'] / (ratio2[0]['wins'] + ratio2[0]['losses'])), 2)
-                db.execute("UPDATE players SET winratio=? WHERE name=?", new_ratio2, name2)
-
-        # If player 2 was the winner
-        if request.form.get('p2set1') > request.form.get('p1set1'):
-            name = str(request.form.get('player2carry'))
-            playerstats = db.execute("SELECT * FROM players WHERE name= :name", name=name)
-
-            # Create variable with values for games, wins + 1
-            games = int(playerstats[0]['games']) + 1
-            wins =  int(playerstats[0]['wins']) + 1
-
-            # Update the table
-            db.execute("UPDATE players SET games = ?, wins = ? WHERE name=?", games, wins, name)
-
-            # Update the ratio columns for both players
-            ratio = db.execute("SELECT * FROM players WHERE name= :name", name=name)
-
-            if ratio[0]['wins'] == 0 and ratio[0]['losses'] == 0:
-                db.execute("UPDATE players SET winratio=0 WHERE name= :name", name=name)
-
-            elif ratio[0]['wins'] == 0 and ratio[0]['losses'] > 0:
-                db.execute("UPDATE players SET winratio=0 WHERE name= :name", name=name)
-
-            elif ratio[0]['wins'] > 0 and ratio[0]['losses'] == 0:
-                db.execute("UPDATE players SET winratio=1 WHERE name= :name", name=name)
-
-            # Case where the ratio needs to be calculated
-            else:
-                new_ratio = round(float(ratio[0]['wins'] / (ratio[0]['wins'] + ratio[0]['losses'])), 2)
-                db.execute("UPDATE players SET winratio=? WHERE name=?", new_ratio, name)
-
-            # Same thing for player 2
-            name2 = str(request.form.get('player1carry'))
-            playerstats2 = db.execute("SELECT * FROM players WHERE name= :name2", name2=name2)
-
-            games2 = int(playerstats2[0]['games']) + 1
-            losses =  int(playerstats2[0]['losses']) + 1
-            db.execute("UPDATE players SET games = ?, losses = ? WHERE name=?", games2, losses, name2)
-
-            # Work out new ratio
-            ratio2 = db.execute("SELECT * FROM players WHERE name= :name2", name2=name2)
-
-            if ratio2[0]['wins'] == 0 and ratio2[0]['losses'] == 0:
-                db.execute("UPDATE players SET winratio=0 WHERE name= :name2", name2=name2)
-
-            elif ratio2[0]['wins'] == 0 and ratio2[0]['losses'] > 0:
-                db.execute("UPDATE players SET winratio=0 WHERE name= :name2", name2=name2)
-
-            elif ratio2[0]['wins'] > 0 and ratio2[0]['losses'] == 0:
-                db.execute("UPDATE players SET winratio=1 WHERE name= :name2", name2=name2)
-
-            else:
-                new_ratio2 = round(float(ratio2[0]['wins'] / (ratio2[0]['wins'] + ratio2[0]['losses'])), 2)
-                db.execute("UPDATE players SET winratio=? WHERE name=?", new_ratio2, name2)
-
-        # Need to update the relevant league table with points and other stats
-        id = '"' + str(request.form.get('leaguecarrycarry')) + '"'
-
-        # Case for when player 1 is the winner
-        if request.form.get('p1set1') > request.form.get('p2set1'):
-            name = str(request.form.get('player1carry'))
-            table = db.execute("SELECT * FROM {} WHERE playername= :name".format(id), name=name)
-
-            # Use existing data to calculate new values for the league table
-            games = table[0]['gamesplayed'] + 1
-            gameswon = table[0]['gameswon'] + 1
-            points = table[0]['points'] + 3
-
-            db.execute('UPDATE {} SET gamesplayed=?, gameswon=?, points=? WHERE playername=?'.format(id), games, gameswon, points, name)
-
-            # Update relevant columns for player 2
-            name2 = str(request.form.get('player2carry'))
-            table2 = db.execute("SELECT * FROM {} WHERE playername= :name2".format(id), name2=name2)
-
-            # Use existing data to calculate new values for the league table
-            games2 = table2[0]['gamesplayed'] + 1
-            gameslost2 = table2[0]['gameslost'] + 1
+            return render_template("recordresults2.html", leagueid=leagueid, leaguename=leaguename, player1=player1, player2=player2)
 
-            db.execute('UPDATE {} SET gamesplayed=?, gameslost=? WHERE playername=?'.format(id), games2, gameslost2, name2)
+        # Score submitted- check it against the same rules used for bulk imports
+        try:
+            p1sets = int(request.form.get('p1set1'))
+            p2sets = int(request.form.get('p2set1'))
+            games = [(game_score(request.form.get('p1game' + str(n))), game_score(request.form.get('p2game' + str(n)))) for n in range(1, 6)]
+        except (TypeError, ValueError):
+            return apology("scores must be whole numbers", 403)
+
+        error = validate_match(p1sets, p2sets, games, request.form.get('date'))
+        if error:
+            return apology(error, 403)
+
+        # If validation passes record the match, the worker updates the tables and live viewers
+        leagueid = request.form.get('leaguecarrycarry')
+        try:
+            record_match(db, leagueid, request.form.get('date'),
+                         request.form.get('player1carry'), request.form.get('player2carry'), p1sets, p2sets, games, userid=session["user_id"])
+        except ValueError as e:
+            return apology(str(e), 403)
+        results_recorded([leagueid])
+        jobs.wake()
 
-           # Case for when player 2 is the winner
-        if request.form.get('p2set1') > request.form.get('p1set1'):
-            name = str(request.form.get('player2carry'))
-            table = db.execute("SELECT * FROM {} WHERE playername= :name".format(id), name=name)
+        flash("Results recorded successfully")
+        leagues = all_leagues(db)
+        y = 0
+        x = len(leagues)
+        return render_template("recordresults.html", leagues=leagues, y=y, x=x)
 
-            # Use existing data to calculate new values for the league table
-            games = table[0]['gamesplayed'] + 1
-            gameswon = table[0]['gameswon'] + 1
-            points = table[0]['points'] + 3
+    else:
+        leagues = all_leagues(db)
+        y = 0
+        x = len(leagues)
+        return render_template("recordresults.html", leagues=leagues, y=y, x=x)
 
-            db.execute('UPDATE {} SET gamesplayed=?, gameswon=?, points=? WHERE playername=?'.format(id), games, gameswon, points, name)
+@app.route("/results/import", methods=["GET", "POST"])
+@login_required
+def importresults():
+    """Allow user to record a whole round of matches from a csv or json file"""
 
-            # Update relevant columns for player 1
-            name2 = str(request.form.get('player1carry'))
-            table2 = db.execute("SELECT * FROM {} WHERE playername= :name2".format(id), name2=name2)
+    if request.method == "POST":
 
-            # Use existing data to calculate new values for the league table
-            games2 = table2[0]['gamesplayed'] + 1
-            gameslost2 = table2[0]['gameslost'] + 1
+        # Matches can come as a json body or as an uploaded csv/json file
+        if request.is_json:
+            matches = request.get_json(silent=True)
+            if not isinstance(matches, list) or not all(isinstance(match, dict) for match in matches):
+                return jsonify(errors=["body must be a json list of matches"]), 400
 
-            db.execute('UPDATE {} SET gamesplayed=?, gameslost=? WHERE playername=?'.format(id), games2, gameslost2, name2)
+        else:
+            upload = request.files.get("file")
+            if not upload or not upload.filename:
+                return apology("must provide a file", 403)
 
-        # Work out pf and pa fields ensuring that the are no non int values
-        if not request.form.get('p1game4') and not request.form.get('p2game4') and not request.form.get('p1game5') and not request.form.get('p2game5'):
-             p1pf = int(request.form.get('p1game1')) + int(request.form.get('p1game2')) + int(request.form.get('p1game3'))
-             p1pa = int(request.form.get('p2game1')) + int(request.form.get('p2game2')) + int(request.form.get('p2game3'))
+            try:
+                matches = read_matches(upload.read().decode("utf-8-sig"), upload.filename)
+            except ValueError:
+                return apology("file must be csv or json", 403)
 
-        elif not request.form.get('p1game5') and not request.form.get('p2game5'):
-             p1pf = int(request.form.get('p1game1')) + int(request.form.get('p1game2')) + int(request.form.get('p1game3')) + int(request.form.get('p1game4'))
-             p1pa = int(request.form.get('p2game1')) + int(request.form.get('p2game2')) + int(request.form.get('p2game3')) + int(request.form.get('p2game4'))
+        errors = import_matches(db, matches, userid=session["user_id"])
+        if not errors:
+            results_recorded({match.get("league_id") for match in matches})
+            jobs.wake()
 
-        else:
-            p1pf = int(request.form.get('p1game1')) + int(request.form.get('p1game2')) + int(request.form.get('p1game3')) + int(request.form.get('p1game4')) + int(request.form.get('p1game5'))
-            p1pa = int(request.form.get('p2game1')) + int(request.form.get('p2game2')) + int(request.form.get('p2game3')) + int(request.form.get('p2game4')) + int(request.form.get('p2game5'))
+        if request.is_json:
+            if errors:
+                return jsonify(errors=errors), 400
+            return jsonify(recorded=len(matches))
 
-        name = request.form.get('player1carry')
-        name2 = request.form.get('player2carry')
+        if errors:
+            return render_template("importresults.html", errors=errors)
 
-        table = db.execute("SELECT * FROM {} WHERE playername= :name".format(id), name=name)
-        table2 = db.execute("SELECT * FROM {} WHERE playername= :name2".format(id), name2=name2)
+        flash("{} results recorded successfully".format(len(matches)))
+        return render_template("importresults.html", errors=[])
 
-        # Generate new pf and pa for player 1 and update the table
-        new_p1pf = table[0]['pf'] + p1pf
-        new_p1pa = table[0]['pa'] + p1pa
-        db.execute('UPDATE {} SET pf=?, pa=? WHERE playername=?'.format(id), new_p1pf, new_p1pa, name)
+    else:
+        return render_template("importresults.html", errors=[])
 
-        # Generate new pf and pa for player 2 and update tables
-        new_p2pf = table2[0]['pf'] + p1pa
-        new_p2pa = table2[0]['pa'] + p1pf
-        db.execute('UPDATE {} SET pf=?, pa=? WHERE playername=?'.format(id), new_p2pf, new_p2pa, name2)
+@app.route("/results/<int:resultid>", methods=["GET", "POST"])
+@login_required
+def editresult(resultid):
+    """Allow user to correct a recorded result and see every change made to it"""
 
-        # Use the new calculated pa and pf values to calculate pd
-        table3 = db.execute("SELECT * FROM {} WHERE playername= :name".format(id), name=name)
-        table4 = db.execute("SELECT * FROM {} WHERE playername= :name2".format(id), name2=name2)
+    rows = db.execute("SELECT * FROM results WHERE id = ?", resultid)
+    if not rows:
+        return apology("result does not exist", 403)
+    result = rows[0]
+    leagueid = result["league_id"]
 
-        pd1 = int(table3[0]['pf']) - int(table3[0]['pa'])
-        pd2 = int(table4[0]['pf']) - int(table4[0]['pa'])
-        db.execute('UPDATE {} SET pd=? WHERE playername=?'.format(id), pd1, name)
-        db.execute('UPDATE {} SET pd=? WHERE playername=?'.format(id), pd2, name2)
+    if request.method == "POST":
+        player1 = request.form.get("player1")
+        player2 = request.form.get("player2")
+        if not player1 or not player2:
+            return apology("must provide names for both players", 403)
 
-        # Finally input all the information recorded into the results table
-        db.execute("INSERT INTO results (league_id, date, player1, player2, p1set, p2set, p1g1, p2g1, p1g2, p2g2, p1g3, p2g3, p1g4, p2g4, p1g5, p2g5) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", request.form.get('leaguecarrycarry'), request.form.get('date'), request.form.get('player1carry'), request.form.get('player2carry'), request.form.get('p1set1'), request.form.get('p2set1'), request.form.get('p1game1'), request.form.get('p2game1'), request.form.get('p1game2'), request.form.get('p2game2'), request.form.get('p1game3'), request.form.get('p2game3'), request.form.get('p1game4'), request.form.get('p2game4'), request.form.get('p1game5'), request.form.get('p2game5'))
-
-        flash("Results recorded successfully")
-        leagues = db.execute("SELECT * FROM leagues")
-        y = 0
-        x = len(leagues)
-        return render_template("recordresults.html", leagues=leagues, y=y, x=x)
+        if player1 == player2:
+            return apology("cannot play a match with one player", 403)
+
+        roster = {row["playername"] for row in league_roster(db, leagueid)}
+        if player1 not in roster or player2 not in roster:
+            return apology("both players must be in the league", 403)
+
+        try:
+            p1sets = int(request.form.get('p1set'))
+            p2sets = int(request.form.get('p2set'))
+            games = [(game_score(request.form.get('p1game' + str(n))), game_score(request.form.get('p2game' + str(n)))) for n in range(1, 6)]
+        except (TypeError, ValueError):
+            return apology("scores must be whole numbers", 403)
+
+        error = validate_match(p1sets, p2sets, games, request.form.get('date'))
+        if error:
+            return apology(error, 403)
+
+        # The old score is taken back out of the standings and the new one added in one go
+        before = watched_tables(broadcaster, db, [leagueid])
+        try:
+            edit_result(db, resultid, session["user_id"], request.form.get('date'), player1, player2, p1sets, p2sets, games)
+        except ValueError as e:
+            return apology(str(e), 403)
+        results_recorded([leagueid])
+        publish_results(broadcaster, db, before, [])
+        jobs.wake()
+
+        flash("Result updated successfully")
+        return redirect("/results/{}".format(resultid))
 
     else:
-        leagues = db.execute("SELECT * FROM leagues")
-        y = 0
-        x = len(leagues)
-        return render_template("recordresults.html", leagues=leagues, y=y, x=x)
+        events = result_events(db, resultid)
+        x = len(events)
+        return render_template("editresult.html", result=result, leaguename=find_league(db, leagueid), events=events, x=x)
+
+@app.route("/results/<int:resultid>/void", methods=["POST"])
+@login_required
+def voidresult(resultid):
+    """Allow user to remove a result recorded in error"""
+
+    rows = db.execute("SELECT league_id FROM results WHERE id = ?", resultid)
+    if not rows:
+        return apology("result does not exist", 403)
+    leagueid = rows[0]["league_id"]
+
+    before = watched_tables(broadcaster, db, [leagueid])
+    void_result(db, resultid, session["user_id"])
+    results_recorded([leagueid])
+    publish_results(broadcaster, db, before, [])
+    jobs.wake()
+
+    flash("Result voided")
+    return redirect("/viewresults?league={}".format(leagueid))
+
+
+@app.cli.command("migrate")
+def migrate_command():
+    """Move standings into league_players and create indexes."""
+    migrate(db)
+    click.echo("Database is up to date")
+
+
+@app.cli.command("rebuild-ratings")
+def rebuildratings_command():
+    """Recompute every player's rating from the full results history."""
+    start = time.perf_counter()
+    replayed = rebuild_ratings(db)
+    click.echo("Rated {} results in {:.2f}s".format(replayed, time.perf_counter() - start))
+
+
+@app.cli.command("rebuild")
+@click.option("--dry-run", is_flag=True, help="Only report discrepancies, change nothing.")
+def rebuild_command(dry_run):
+    """Recompute player and league table counters from the results table."""
+    start = time.perf_counter()
+    players, leaguerows, strays = rebuild_standings(db, repair=not dry_run)
+
+    for row in players:
+        click.echo("player {}: {}".format(row["name"], ", ".join("{} {} -> {}".format(column, row[column], row["expected_" + column])
+                                                                for column in PLAYER_COUNTERS if row[column] != row["expected_" + column])))
+    for row in leaguerows:
+        click.echo("league {} player {}: {}".format(row["league_id"], row["name"], ", ".join("{} {} -> {}".format(column, row[column], row["expected_" + column])
+                                                                                             for column in LEAGUE_COUNTERS if row[column] != row["expected_" + column])))
+    for row in strays:
+        click.echo("league {} has {} results for {}, who is not in its table".format(row["league_id"], row["results"], row["name"]), err=True)
+
+    click.echo("{} {} players and {} league table rows in {:.2f}s".format("Found" if dry_run else "Repaired", len(players), len(leaguerows),
+                                                                          time.perf_counter() - start))
+
+
+@app.cli.command("refresh-stats")
+def refreshstats_command():
+    """Recompute every player's stats and form from the results table."""
+    start = time.perf_counter()
+    players = refresh_stats(db)
+    click.echo("Refreshed stats for {} players in {:.2f}s".format(players, time.perf_counter() - start))
+
+
+@app.cli.command("compile-rankings")
+def compilerankings_command():
+    """Compile the rankings files into one snapshot mapped at startup."""
+    seasons = [rankings.get(year, gender, period) for year, period, gender in rankings.keys()]
+    write_snapshot(SNAPSHOT_FILE, seasons)
+    click.echo("Compiled {} rankings files ({} rows) into {}".format(len(seasons), sum(len(season) for season in seasons), SNAPSHOT_FILE))
+
+
+@app.cli.command("ingest-rankings")
+@click.argument("filename", type=click.Path(exists=True, dir_okay=False))
+@click.option("--gender", type=click.Choice(["male", "female"]), help="Use instead of the Gender column most rows agree on.")
+@click.option("--replace", is_flag=True, help="Replace a period already in the store.")
+def ingestrankings_command(filename, gender, replace):
+    """Add one ITTF rankings csv as a new week or month, with movement since the one before."""
+    with open(filename, encoding="utf-8-sig", newline="") as file:
+        try:
+            season = ingest_rankings(rankings, file, gender, replace)
+        except ValueError as e:
+            click.echo(e, err=True)
+            raise SystemExit(1)
+
+    # A compiled snapshot is rewritten from the seasons already in memory
+    if os.path.exists(SNAPSHOT_FILE):
+        write_snapshot(SNAPSHOT_FILE, [rankings.get(year, gender, period) for year, period, gender in rankings.keys()])
+
+    click.echo("Ingested {} {} {} rankings ({} players)".format(season.year, season.period, season.gender, len(season)))
+
+
+@app.cli.command("import-results")
+@click.argument("filename", type=click.Path(exists=True, dir_okay=False))
+def importresults_command(filename):
+    """Record a round of matches from a csv or json file."""
+    with open(filename, encoding="utf-8-sig") as file:
+        try:
+            matches = read_matches(file.read(), filename)
+        except ValueError as e:
+            click.echo(e, err=True)
+            raise SystemExit(1)
+
+    errors = import_matches(db, matches)
+
+    for error in errors:
+        click.echo(error, err=True)
+
+    if errors:
+        raise SystemExit(1)
+
+    # Apply them before exiting rather than waiting for a server's worker
+    jobs.drain()
+    click.echo("{} results recorded".format(len(matches)))
+
+
+@app.cli.command("run-jobs")
+@click.option("--retry", is_flag=True, help="Run jobs that failed too often again.")
+def runjobs_command(retry):
+    """Run every queued job now, such as results waiting to be applied."""
+    if retry:
+        click.echo("Retrying {} failed jobs".format(jobs.retry()))
+
+    ran = jobs.drain()
+    stats = jobs.stats()
+    click.echo("Ran {} jobs, {} still queued ({} failed)".format(ran, stats["pending"], stats["failed"]))
 
 @app.route("/viewresults", methods=["GET", "POST"])
 @login_required
 def viewresults():
     """Allow user view match scores"""
 
+    # League comes from the filter form, or from the links between pages
     if request.method == "POST":
         leagueid = request.form.get("league")
+    else:
+        leagueid = request.args.get("league")
+
+    # Cursors for paging through older or newer results
+    before = parse_cursor(request.args.get("before")) if request.args.get("before") else None
+    after = parse_cursor(request.args.get("after")) if request.args.get("after") else None
+
+    if (request.args.get("before") and not before) or (request.args.get("after") and not after):
+        return apology("invalid results page", 403)
+
+    leagues = all_leagues(db)
+
+    if leagueid:
 
         # Create a variable for the league name to be used in the html
-        name = db.execute("SELECT * FROM leagues WHERE id= :id", id=leagueid)
-        leagues = db.execute("SELECT * FROM leagues")
+        name = find_league(db, leagueid)
+        if not name:
+            return apology("league does not exist", 403)
 
-        # Create a dict with the sorted list of results for the relevant league
-        results = db.execute("SELECT * FROM results WHERE league_id= :id ORDER BY date DESC", id=leagueid)
-        y, x, z = 0, len(results), len(leagues)
+        def render():
+            # One page of the sorted results for the relevant league
+            results, newer, older = results_page(db, leagueid, before, after)
+            y, x, z = 0, len(results), len(leagues)
 
-        return render_template("results1.html", name=name, results=results, y=y, x=x, leagues=leagues, z=z)
+            return render_template("results1.html", name=name, results=results, y=y, x=x, leagues=leagues, z=z,
+                                   leagueid=leagueid, newer=newer, older=older)
+
+        etag = "results-" + page_version(db, name[0]["id"])
 
     else:
-        leagues = db.execute("SELECT * FROM leagues")
-        results = db.execute("SELECT * FROM results ORDER BY date DESC")
-        y, x, z = 0, len(leagues), len(results)
-        names = list()
+        def render():
+            # League names come from the same query as the results
+            results, newer, older = results_page(db, None, before, after)
+            y, x, z = 0, len(leagues), len(results)
+
+            return render_template('results.html', leagues=leagues, results=results, y=y, x=x, z=z, newer=newer, older=older)
 
-        for n in range(z):
-            id = int(results[n]['league_id'])
-            name = db.execute("SELECT name FROM leagues WHERE id= :id", id=id)
-            names.append(name[0]['name'])
+        etag = "results-" + page_version(db)
 
-        return render_template('results.html', leagues=leagues, results=results, y=y, x=x, z=z, names=names)
+    # Pages only change when a result is recorded, so repeat visits can be answered with 304
+    return conditional("{}-{}-{}".format(etag, request.args.get("before", ""), request.args.get("after", "")), 0, render)
+
+@app.route("/cache/stats")
+@login_required
+def cachestats():
+    """Report hit and miss counters for the read cache"""
+    return jsonify(cache.stats())
+
+@app.route("/metrics")
+def metricsview():
+    """Report per route query and timing histograms with the read cache and job queue counters"""
+    # Behind a proxy every client looks local, so only the token is trusted
+    if not METRICS_TOKEN:
+        return apology("metrics need METRICS_TOKEN set", 403)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer " + METRICS_TOKEN):
+        return apology("metrics need a valid token", 403)
+
+    gauges = {"cache_" + name: value for name, value in cache.stats().items()}
+    gauges.update({"jobs_" + name: value for name, value in jobs.stats().items()})
+    gauges["results_failed"] = db.execute("SELECT COUNT(*) AS n FROM results WHERE applied = ?", FAILED)[0]["n"]
+    return Response(metrics.render(gauges), mimetype="text/plain")
 
 def errorhandler(e):
     """Handle error"""
@@ -723,3 +1028,9 @@ def errorhandler(e):
 # Listen for errors
 for code in default_exceptions:
     app.errorhandler(code)(errorhandler)
+
+
+@app.errorhandler(PasswordsBusy)
+def passwordsbusy(e):
+    """Turn requests away while every password hashing slot is taken"""
+    return apology("too many logins at once, try again", 503)
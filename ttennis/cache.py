@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """Bounded read-through cache that evicts the least recently used entry.
+
+    Keys are tuples whose first items name what was read, e.g.
+    ("standings", 15), so a whole group can be dropped by prefix.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, load):
+        """Return the cached value for key, calling load() to fill it on a miss."""
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            generation = self._generation
+
+        value = load()
+
+        with self._lock:
+            # Skip storing if a write invalidated entries while this was loading
+            if generation == self._generation:
+                self._data[key] = value
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, *prefix):
+        """Drop every entry whose key starts with prefix, or everything if none given."""
+        with self._lock:
+            self._generation += 1
+            for key in [key for key in self._data if key[:len(prefix)] == prefix]:
+                del self._data[key]
+
+    def stats(self):
+        """Return counters for sizing the cache."""
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
@@ -0,0 +1,124 @@
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+
+
+class Database:
+    """SQLite access with one connection per thread.
+
+    execute() behaves like the cs50 SQL handle it replaces: SELECTs return a
+    list of dicts, INSERTs the new row id and UPDATE/DELETE the number of
+    rows changed. Statements run in autocommit mode unless wrapped in
+    transaction().
+
+    If on_query is set it is called with each statement and the seconds it
+    took to run.
+    """
+
+    def __init__(self, path, timeout=30, cached_statements=256):
+        self.path = path
+        self.timeout = timeout
+        self.cached_statements = cached_statements
+        self.on_query = None
+        self._local = threading.local()
+
+    def connect(self):
+        """Open a new connection tuned for many readers and one writer."""
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                               check_same_thread=False, cached_statements=self.cached_statements)
+        conn.row_factory = sqlite3.Row
+
+        # Readers no longer block behind a writer with WAL, and NORMAL sync is safe with it
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout={}".format(int(self.timeout * 1000)))
+        return conn
+
+    @property
+    def connection(self):
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close this thread's connection if it has one."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def run(self, sql, params=(), many=False):
+        """Run a statement on this thread's connection, reporting it to on_query."""
+        conn = self.connection
+        if self.on_query is None:
+            return conn.executemany(sql, params) if many else conn.execute(sql, params)
+
+        start = time.perf_counter()
+        cursor = conn.executemany(sql, params) if many else conn.execute(sql, params)
+        self.on_query(sql, time.perf_counter() - start)
+        return cursor
+
+    def execute(self, sql, *args, **kwargs):
+        """Run one statement, taking ? parameters as args or :name ones as kwargs."""
+        cursor = self.run(sql, kwargs if kwargs else args)
+
+        if cursor.description is not None:
+            return [dict(row) for row in cursor.fetchall()]
+
+        command = sql.lstrip().split(None, 1)[0].upper()
+        if command == "INSERT":
+            return cursor.lastrowid
+        if command in ("UPDATE", "DELETE"):
+            return cursor.rowcount
+        return True
+
+    def iterate(self, sql, *args, **kwargs):
+        """Yield the rows of a SELECT one at a time instead of building a list."""
+        cursor = self.run(sql, kwargs if kwargs else args)
+        try:
+            for row in cursor:
+                yield dict(row)
+        finally:
+            cursor.close()
+
+    def executemany(self, sql, rows):
+        """Run one statement for every parameter set in rows, returning rows changed."""
+        return self.run(sql, rows, many=True).rowcount
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements as one write transaction.
+
+        The write lock is taken up front so concurrent writers queue on the
+        busy timeout rather than failing part way through. Nested uses join
+        the outer transaction.
+        """
+        conn = self.connection
+        if conn.in_transaction:
+            yield self
+            return
+
+        self.run("BEGIN IMMEDIATE")
+        try:
+            yield self
+        except BaseException:
+            self.run("ROLLBACK")
+            raise
+        self.run("COMMIT")
+
+    @contextmanager
+    def savepoint(self, name="nested"):
+        """Run the enclosed statements inside the current transaction so a failure undoes only them."""
+        self.run("SAVEPOINT " + name)
+        try:
+            yield self
+        except BaseException:
+            self.run("ROLLBACK TO " + name)
+            self.run("RELEASE " + name)
+            raise
+        self.run("RELEASE " + name)
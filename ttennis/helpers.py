@@ -2,7 +2,7 @@ import os
 import requests
 import urllib.parse
 
-from flask import redirect, render_template, request, session
+from flask import make_response, redirect, render_template, request, session
 from functools import wraps
 
 
@@ -34,6 +34,57 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def conditional(etag, max_age, render):
+    """
+    Answer a GET with 304 Not Modified if the client's copy is current.
+
+    render() is only called when the page has to be sent, so an unchanged
+    page costs no queries and no template rendering.
+    """
+    # Pending flash messages are part of the page so it must be rendered
+    if request.method != "GET" or session.get("_flashes"):
+        return render()
+
+    if request.if_none_match.contains_weak(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+
+    response.set_etag(etag, weak=True)
+    if max_age:
+        response.headers["Cache-Control"] = "private, max-age={}".format(max_age)
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+def secret_key(path):
+    """
+    Return the key used to sign session cookies.
+
+    SECRET_KEY in the environment is used if set. Otherwise the key is kept
+    in path, created by whichever worker starts first, so that every worker
+    signs and accepts the same cookies.
+    """
+    if os.environ.get("SECRET_KEY"):
+        return os.environ["SECRET_KEY"]
+
+    # Write a new key aside then link it into place, failing if another worker got there first
+    tmp = "{}.{}".format(path, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as file:
+        file.write(os.urandom(32))
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp)
+
+    with open(path, "rb") as file:
+        return file.read()
+
 def usd(value):
     """Format value as USD."""
     return f"${value:,.2f}"
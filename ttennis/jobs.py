@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+
+# Give up on a job after this many failures, it stays queued for inspection
+MAX_ATTEMPTS = 5
+
+# Seconds before the first retry, doubling after each failure
+RETRY_DELAY = 2
+
+# Seconds the worker sleeps between checks when nothing has woken it
+POLL_INTERVAL = 5
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(db, kind, key):
+    """Queue a job inside the caller's transaction.
+
+    Jobs are coalesced: while a job of this kind and key is waiting another
+    is not added, and the waiting one picks up the new work when it runs.
+    A waiting job that has been failing is made due again with its attempts
+    reset, so it cannot swallow new work.
+    """
+    db.execute("INSERT INTO jobs (kind, key, created, run_after) VALUES (?, ?, ?, ?) "
+               "ON CONFLICT (kind, key) DO UPDATE SET attempts = 0, run_after = 0",
+               kind, str(key), time.time(), 0)
+
+
+class JobQueue:
+    """Durable queue of derived work kept in the jobs table, run by a background thread.
+
+    Each job runs in one transaction with its own removal from the queue, so
+    a crash or error leaves it queued and handlers must be safe to run again.
+    Failed jobs are retried with exponential backoff up to MAX_ATTEMPTS.
+    """
+
+    def __init__(self, db, poll=POLL_INTERVAL):
+        self.db = db
+        self.poll = poll
+        self.handlers = {}
+        self._wake = threading.Event()
+        self._thread = None
+
+    def register(self, kind, handler, after=None):
+        """Run handler(db, key) for jobs of kind, then after(key, result) once it has committed."""
+        self.handlers[kind] = (handler, after)
+
+    def wake(self):
+        """Tell the worker new jobs are waiting."""
+        self._wake.set()
+
+    def start(self):
+        """Start the worker thread, which first runs any jobs left from before a restart."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.work, name="jobs", daemon=True)
+            self._thread.start()
+
+    def work(self):
+        while True:
+            try:
+                ran = self.run_next()
+            except Exception:
+                logger.exception("job queue failed")
+                ran = False
+            if not ran:
+                self._wake.wait(self.poll)
+                self._wake.clear()
+
+    def drain(self):
+        """Run every job that is due in this thread, returning how many ran."""
+        ran = 0
+        while self.run_next():
+            ran += 1
+        return ran
+
+    def run_next(self):
+        """Run the oldest due job, returning False if there was none."""
+        job = None
+        try:
+            with self.db.transaction():
+                jobs = self.db.execute("SELECT * FROM jobs WHERE attempts < ? AND run_after <= ? ORDER BY id LIMIT 1", MAX_ATTEMPTS, time.time())
+                if not jobs:
+                    return False
+                job = jobs[0]
+
+                handler, after = self.handlers[job["kind"]]
+                result = handler(self.db, job["key"])
+                self.db.execute("DELETE FROM jobs WHERE id = ?", job["id"])
+
+        except Exception as e:
+            if job is None:
+                raise
+            logger.exception("job %s %s %s failed", job["id"], job["kind"], job["key"])
+            self.db.execute("UPDATE jobs SET attempts = attempts + 1, run_after = ?, error = ? WHERE id = ?",
+                            time.time() + RETRY_DELAY * 2 ** job["attempts"], repr(e), job["id"])
+            return True
+
+        if after is not None:
+            after(job["key"], result)
+        return True
+
+    def retry(self):
+        """Make jobs that failed MAX_ATTEMPTS times due again, returning how many."""
+        return self.db.execute("UPDATE jobs SET attempts = 0, run_after = 0 WHERE attempts >= ?", MAX_ATTEMPTS)
+
+    def stats(self):
+        """Return queue depth counters for the metrics page."""
+        row = self.db.execute("SELECT COUNT(*) AS pending, COALESCE(SUM(attempts >= ?), 0) AS failed, "
+                              "COALESCE(SUM(attempts > 0 AND attempts < ?), 0) AS retrying, MIN(created) AS oldest FROM jobs",
+                              MAX_ATTEMPTS, MAX_ATTEMPTS)[0]
+        return {"pending": row["pending"], "failed": row["failed"], "retrying": row["retrying"],
+                "oldest_seconds": round(time.time() - row["oldest"], 3) if row["oldest"] is not None else 0}
@@ -0,0 +1,112 @@
+import json
+import queue
+
+from threading import Lock
+
+from queries import league_table
+
+# Events a subscriber may fall behind by before it is dropped
+BACKLOG = 32
+
+# Seconds between keepalive comments on an idle stream
+KEEPALIVE = 15
+
+
+class Broadcaster:
+    """Fan out events to every subscriber of a channel in this process.
+
+    Each subscriber has its own bounded queue, so publishing never blocks on
+    a slow client. A subscriber whose queue is full is dropped and its
+    stream ends, and the browser reconnects.
+    """
+
+    def __init__(self, backlog=BACKLOG):
+        self.backlog = backlog
+        self._channels = {}
+        self._lock = Lock()
+
+    def subscribers(self, channel):
+        with self._lock:
+            return len(self._channels.get(channel, ()))
+
+    def subscribe(self, channel):
+        subscriber = queue.Queue(self.backlog)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self._lock:
+            subscribers = self._channels.get(channel)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._channels[channel]
+
+    def publish(self, channel, event):
+        """Send event to every subscriber of channel."""
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(event)
+            except queue.Full:
+                self.unsubscribe(channel, subscriber)
+                self.close(subscriber)
+
+    def close(self, subscriber):
+        """Tell a dropped subscriber's stream to end, making room in its queue if need be."""
+        try:
+            subscriber.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            subscriber.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def listen(self, channel, keepalive=KEEPALIVE):
+        """Yield Server-Sent Events text for channel until the subscriber is dropped."""
+        subscriber = self.subscribe(channel)
+        try:
+            # Browsers wait this many milliseconds before reconnecting
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    return
+                yield "event: {}\ndata: {}\n\n".format(event["type"], json.dumps(event["data"]))
+        finally:
+            self.unsubscribe(channel, subscriber)
+
+
+def standings_diff(before, after):
+    """Return the rows of the after table that are new or changed, with their 1 based position."""
+    previous = {row["player_id"]: (position, row) for position, row in enumerate(before, 1)}
+    return [dict(row, position=position) for position, row in enumerate(after, 1)
+            if previous.get(row["player_id"]) != (position, row)]
+
+
+def watched_tables(broadcaster, db, leagueids):
+    """Return the current standings of each league someone is watching, before results change them."""
+    return {str(leagueid): league_table(db, leagueid) for leagueid in set(map(str, leagueids)) if broadcaster.subscribers(str(leagueid))}
+
+
+def publish_results(broadcaster, db, before, results):
+    """Push each watched league's changed standings and new results to its viewers.
+
+    before is what watched_tables() returned. The new standings are read once
+    per league however many viewers there are, and the read is cached for
+    the next page load.
+    """
+    for leagueid, table in before.items():
+        broadcaster.publish(leagueid, {"type": "results", "data": {
+            "league": int(leagueid),
+            "standings": standings_diff(table, league_table(db, leagueid)),
+            "results": [result for result in results if str(result["league_id"]) == leagueid],
+        }})
@@ -0,0 +1,123 @@
+import time
+
+from threading import Lock
+
+from flask import before_render_template, g, has_request_context, request, template_rendered
+
+# Histogram bucket upper bounds, in seconds for timings
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# Series kept for every route, with their buckets and help text
+SERIES = {
+    "request_seconds": (TIME_BUCKETS, "Time to handle the request"),
+    "sql_seconds": (TIME_BUCKETS, "Time spent running SQL"),
+    "render_seconds": (TIME_BUCKETS, "Time spent rendering templates"),
+    "queries": (QUERY_BUCKETS, "SQL statements run"),
+}
+
+
+class Histogram:
+    """Cumulative bucket counts with a sum and count, as exposed to Prometheus."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Per route histograms of request time, SQL time, render time and query count.
+
+    SQL is measured through the Database's on_query hook and rendering
+    through Flask's template signals. With slow_ms set, requests taking at
+    least that long are logged with every statement they ran.
+    """
+
+    def __init__(self, slow_ms=0):
+        self.slow_ms = slow_ms
+        self.logger = None
+        self.routes = {}
+        self._lock = Lock()
+
+    def init_app(self, app, db):
+        self.logger = app.logger
+        db.on_query = self.query
+        app.before_request(self.start)
+        app.teardown_request(self.finish)
+        before_render_template.connect(self.rendering, app)
+        template_rendered.connect(self.rendered, app)
+
+    def start(self):
+        g.metrics = {"start": time.perf_counter(), "queries": 0, "sql": 0.0, "render": 0.0,
+                     "statements": [] if self.slow_ms else None}
+
+    def query(self, sql, seconds):
+        """Add one statement to the current request, if there is one."""
+        if not has_request_context() or "metrics" not in g:
+            return
+        g.metrics["queries"] += 1
+        g.metrics["sql"] += seconds
+        if g.metrics["statements"] is not None:
+            g.metrics["statements"].append((seconds, sql))
+
+    def rendering(self, sender, template, context, **extra):
+        if "metrics" in g:
+            g.metrics["render_start"] = time.perf_counter()
+
+    def rendered(self, sender, template, context, **extra):
+        if "metrics" in g and "render_start" in g.metrics:
+            g.metrics["render"] += time.perf_counter() - g.metrics.pop("render_start")
+
+    def finish(self, exc=None):
+        """Record the request, after any streamed body has been sent."""
+        current = g.pop("metrics", None)
+        if current is None:
+            return
+
+        total = time.perf_counter() - current["start"]
+        route = request.endpoint or "unmatched"
+
+        with self._lock:
+            series = self.routes.get(route)
+            if series is None:
+                series = self.routes[route] = {name: Histogram(buckets) for name, (buckets, help) in SERIES.items()}
+            series["request_seconds"].observe(total)
+            series["sql_seconds"].observe(current["sql"])
+            series["render_seconds"].observe(current["render"])
+            series["queries"].observe(current["queries"])
+
+        if self.slow_ms and total * 1000 >= self.slow_ms:
+            self.logger.warning("slow request %s %s: %.1fms, %d queries in %.1fms, render %.1fms\n%s",
+                                request.method, request.full_path, total * 1000, current["queries"], current["sql"] * 1000,
+                                current["render"] * 1000, "\n".join("  {:8.2f}ms {}".format(seconds * 1000, " ".join(sql.split()))
+                                                                    for seconds, sql in current["statements"]))
+
+    def render(self, gauges=None):
+        """Return every histogram, plus any extra gauges, in the Prometheus text format."""
+        lines = []
+        with self._lock:
+            for name, (buckets, help) in SERIES.items():
+                lines.append("# HELP ttennis_{} {}".format(name, help))
+                lines.append("# TYPE ttennis_{} histogram".format(name))
+                for route, series in sorted(self.routes.items()):
+                    histogram = series[name]
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append('ttennis_{}_bucket{{route="{}",le="{}"}} {}'.format(name, route, bound, count))
+                    lines.append('ttennis_{}_bucket{{route="{}",le="+Inf"}} {}'.format(name, route, histogram.count))
+                    lines.append('ttennis_{}_sum{{route="{}"}} {}'.format(name, route, round(histogram.sum, 6)))
+                    lines.append('ttennis_{}_count{{route="{}"}} {}'.format(name, route, histogram.count))
+
+        for name, value in sorted((gauges or {}).items()):
+            lines.append("# TYPE ttennis_{} gauge".format(name))
+            lines.append("ttennis_{} {}".format(name, value))
+
+        return "\n".join(lines) + "\n"
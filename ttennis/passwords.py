@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Hash method for new passwords, pbkdf2 methods that do not name their iterations get ITERATIONS
+METHOD = "pbkdf2:sha256"
+ITERATIONS = 600000
+
+# Processes hashing at once, and hashes that may wait for one before callers are turned away
+WORKERS = min(4, os.cpu_count() or 1)
+BACKLOG = 16
+
+# Seconds a caller waits for a free slot in the backlog, then for its hash
+WAIT = 5
+
+# Failed logins allowed per username in WINDOW seconds before it is locked out for the rest of it
+ATTEMPTS = 5
+WINDOW = 300
+
+# Usernames with failures remembered at once, so a flood of made up names cannot use up memory
+TRACKED = 10000
+
+
+class PasswordsBusy(Exception):
+    """Raised when every hashing slot is taken for longer than a caller will wait."""
+
+
+def method_spec(method, iterations):
+    """Return werkzeug's method string, adding iterations to a pbkdf2 method that has none."""
+    if method.startswith("pbkdf2:") and method.count(":") == 1:
+        return "{}:{}".format(method, iterations)
+    return method
+
+
+class Passwords:
+    """Hash and check passwords in a bounded process pool, off the request threads.
+
+    At most workers hashes run at once and backlog more may wait, so a burst
+    of logins queues here instead of tying up every thread on PBKDF2. Failed
+    attempts are counted per username, and a locked out username is refused
+    before any hashing is done.
+    """
+
+    def __init__(self, method=METHOD, iterations=ITERATIONS, workers=WORKERS, backlog=BACKLOG,
+                 attempts=ATTEMPTS, window=WINDOW, wait=WAIT):
+        self.method = method_spec(method, iterations)
+        self.workers = workers
+        self.attempts = attempts
+        self.window = window
+        self.wait = wait
+        self._slots = BoundedSemaphore(workers + backlog)
+        self._pool = None
+        self._failures = {}
+        self._lock = Lock()
+
+        # werkzeug fills in defaults, such as scrypt's parameters, so compare against a hash it made
+        self._prefix = generate_password_hash("", self.method).split("$", 1)[0]
+
+    def run(self, function, *args):
+        """Run function in the pool, started on first use with fresh processes rather than forks of this threaded one."""
+        if not self._slots.acquire(timeout=self.wait):
+            raise PasswordsBusy()
+        try:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            future = self._pool.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # The slot is held until the hash really finishes, even if this caller gives up waiting for it
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(timeout=self.wait * 2)
+        except TimeoutError:
+            raise PasswordsBusy()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    def verify(self, stored, password):
+        return self.run(check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        """Return True if stored was made with a different method or work factor than new hashes."""
+        return stored.split("$", 1)[0] != self._prefix
+
+    def throttled(self, username):
+        """Return True if username has failed too often to try again yet."""
+        with self._lock:
+            failures = self._failures.get(username)
+            if failures is None:
+                return False
+            count, start = failures
+            if time.monotonic() - start >= self.window:
+                del self._failures[username]
+                return False
+            return count >= self.attempts
+
+    def failed(self, username):
+        """Count a failed attempt against username."""
+        now = time.monotonic()
+        with self._lock:
+            count, start = self._failures.get(username, (0, now))
+            if now - start >= self.window:
+                count, start = 0, now
+            self._failures[username] = (count + 1, start)
+
+            # Forget expired windows, then the oldest, once too many names are tracked
+            if len(self._failures) > TRACKED:
+                for name, (count, start) in list(self._failures.items()):
+                    if now - start >= self.window:
+                        del self._failures[name]
+                while len(self._failures) > TRACKED:
+                    del self._failures[next(iter(self._failures))]
+
+    def succeeded(self, username):
+        with self._lock:
+            self._failures.pop(username, None)
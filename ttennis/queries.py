@@ -0,0 +1,135 @@
+import json
+
+from cache import LRUCache
+from standings import STAT_COLUMNS
+
+# Orders offered on the players page, names ascending and everything else descending
+PLAYER_ORDERS = {"name": "ASC", "dob": "DESC", "games": "DESC", "wins": "DESC", "losses": "DESC", "winratio": "DESC", "rating": "DESC"}
+
+# League lists, standings and player lists are read far more often than they change. Keys carry
+# the versions the database keeps, so a write by any process makes every process's entries stale.
+cache = LRUCache(maxsize=256)
+
+
+def league_version(db, leagueid):
+    """Return the league's version, bumped in the database by every write to its standings."""
+    rows = db.execute("SELECT version FROM leagues WHERE id = ?", leagueid)
+    return rows[0]["version"] if rows else 0
+
+
+def data_version(db, name):
+    """Return the shared counter the database bumps whenever the named table changes."""
+    rows = db.execute("SELECT version FROM data_versions WHERE name = ?", name)
+    return rows[0]["version"] if rows else 0
+
+
+def all_leagues(db):
+    """Return every league."""
+    return cache.get(("leagues", page_version(db)), lambda: db.execute("SELECT * FROM leagues"))
+
+
+def find_league(db, leagueid):
+    """Return a list holding the league with this id, empty if there is none."""
+    return [league for league in all_leagues(db) if str(league["id"]) == str(leagueid)]
+
+
+def league_table(db, leagueid):
+    """Return the standings for a league in table order."""
+    return cache.get(("standings", str(leagueid), league_version(db, leagueid)), lambda: db.execute(
+        "SELECT players.name AS playername, league_players.* FROM league_players JOIN players ON players.id = league_players.player_id "
+        "WHERE league_id = ? ORDER BY points DESC, pd DESC, playername", leagueid))
+
+
+def league_roster(db, leagueid):
+    """Return the names of the players entered in a league."""
+    return cache.get(("roster", str(leagueid), league_version(db, leagueid)), lambda: db.execute(
+        "SELECT players.name AS playername FROM league_players JOIN players ON players.id = league_players.player_id "
+        "WHERE league_id = ?", leagueid))
+
+
+def league_head_to_head(db, leagueid):
+    """Return a league's head to head records keyed by (player id, opponent id)."""
+    return cache.get(("headtohead", str(leagueid), league_version(db, leagueid)), lambda: {
+        (row["player_id"], row["opponent_id"]): row for row in db.execute("SELECT * FROM head_to_head WHERE league_id = ?", leagueid)})
+
+
+def all_players(db, order=None):
+    """Return every player, sorted by one of PLAYER_ORDERS or in table order if None."""
+    version = data_version(db, "players")
+    if order is None:
+        return cache.get(("players", None, version), lambda: db.execute("SELECT * FROM players"))
+
+    return cache.get(("players", order, version), lambda: db.execute(
+        "SELECT * FROM players ORDER BY {} {}".format(order, PLAYER_ORDERS[order])))
+
+
+def player_stats(db, playerid):
+    """Return a player joined with their stats row, or None if there is no such player."""
+    rows = db.execute("SELECT players.id, players.name, players.gender, players.dob, players.rating, {} FROM players LEFT JOIN player_stats ON player_stats.player_id = players.id "
+                      "WHERE players.id = ?".format(", ".join("COALESCE(player_stats.{0}, 0) AS {0}".format(column) for column in STAT_COLUMNS)
+                                                     + ", COALESCE(player_stats.form, '') AS form"), playerid)
+    if not rows:
+        return None
+
+    stats = rows[0]
+    stats["points_per_game"] = round(stats["points_won"] / stats["games_played"], 2) if stats["games_played"] else 0
+    stats["set_ratio"] = round(stats["sets_won"] / (stats["sets_won"] + stats["sets_lost"]), 2) if stats["sets_won"] + stats["sets_lost"] else 0
+    return stats
+
+
+def result_events(db, resultid):
+    """Return the event log for a result, oldest first, with who made each change and the values it left."""
+    events = db.execute("SELECT match_events.*, users.username FROM match_events LEFT JOIN users ON users.id = match_events.user_id "
+                        "WHERE result_id = ? ORDER BY match_events.id", resultid)
+    for event in events:
+        event["data"] = json.loads(event["data"])
+    return events
+
+
+def search_players(db, prefix, limit, leagueid=None):
+    """Return up to limit player names starting with prefix, ignoring case, optionally only those in a league."""
+    pattern = prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+    if leagueid is None:
+        # Served by the NOCASE name index, so the cost depends on limit rather than the number of players
+        rows = db.execute("SELECT name FROM players WHERE name LIKE ? ESCAPE '\\' ORDER BY name COLLATE NOCASE LIMIT ?", pattern, limit)
+    else:
+        rows = db.execute("SELECT players.name FROM league_players JOIN players ON players.id = league_players.player_id "
+                          "WHERE league_players.league_id = ? AND players.name LIKE ? ESCAPE '\\' ORDER BY players.name COLLATE NOCASE LIMIT ?",
+                          leagueid, pattern, limit)
+    return [row["name"] for row in rows]
+
+
+def page_version(db, leagueid=None):
+    """Return a tag that changes whenever the league list, or a league's results, change.
+
+    Read from the database rather than the cache on every call, so each
+    worker process sees the others' writes straight away.
+    """
+    if leagueid is None:
+        row = db.execute("SELECT COUNT(*) AS n, COALESCE(SUM(version), 0) AS version FROM leagues")[0]
+        return "{}-{}".format(row["n"], row["version"])
+
+    rows = db.execute("SELECT (SELECT COUNT(*) FROM leagues) AS n, version FROM leagues WHERE id = ?", leagueid)
+    return "{}-{}-{}".format(rows[0]["n"] if rows else 0, leagueid, rows[0]["version"] if rows else 0)
+
+
+def league_created():
+    """Drop this process's cached reads made stale by a new league, rather than leave them to age out."""
+    cache.invalidate("leagues")
+
+
+def players_changed():
+    """Forget cached reads made stale by a new player."""
+    cache.invalidate("players")
+
+
+def results_recorded(leagueids):
+    """Forget cached reads made stale by results recorded in these leagues."""
+    for leagueid in leagueids:
+        cache.invalidate("standings", str(leagueid))
+        cache.invalidate("headtohead", str(leagueid))
+    cache.invalidate("players")
+
+    # League versions are part of the league list
+    cache.invalidate("leagues")
@@ -0,0 +1,468 @@
+import csv
+import hashlib
+import io
+import os
+import re
+import sys
+import tempfile
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, namedtuple
+from threading import Lock
+
+# Folder holding one ITTF csv per period and gender, e.g. rankings/2020W15male.csv for week 15 or
+# rankings/2020M05male.csv for May. Older files like rankings/2020male.csv have no period in their name and are placed
+# by the WeekNum or MonthNum of their rows.
+RANKINGS_DIR = "rankings"
+FILENAME = re.compile(r"^(\d{4})([WM]\d{2})?(male|female)\.csv$")
+PERIOD = re.compile(r"^[WM]\d{2}$")
+
+# Columns of an ITTF rankings csv, as written by ingest_rankings()
+CSV_COLUMNS = ["Rank", "Previous", "ID", "Assoc", "Gender", "Name", "Points", "Previous Points", "WeekNum", "MonthNum", "YearNum"]
+# Gender column values, ITTF files use W for women
+GENDERS = {"M": "male", "F": "female", "W": "female"}
+
+# One row of a rankings file, built only when a page asks for it
+Ranking = namedtuple("Ranking", ["rank", "previous", "id", "assoc", "name", "points", "previous_points"])
+
+# A player's entry in one period's rankings
+Career = namedtuple("Career", ["year", "period", "gender", "ranking"])
+
+
+def to_int(value):
+    """Convert a csv field to int, treating blanks (new entries) as 0."""
+    return int(value) if value else 0
+
+
+def period_name(week, month):
+    """Return the period for a rankings week or month number, W15 or M05."""
+    if week:
+        return "W{:02d}".format(week)
+    if month:
+        return "M{:02d}".format(month)
+    return ""
+
+
+def file_period(path):
+    """Return the period named by a rankings file's first row, for older files without one in their name."""
+    with open(path, encoding="utf-8-sig", newline="") as rankingcsv:
+        row = next(csv.DictReader(rankingcsv), None)
+    try:
+        return period_name(to_int(row["WeekNum"]), to_int(row["MonthNum"]))
+    except (TypeError, KeyError, ValueError):
+        return ""
+
+
+def period_order(period):
+    """Return roughly the day of the year a period starts, for sorting weeks and months together."""
+    if not period:
+        return 0
+    if period[0] == "W":
+        return int(period[1:]) * 7 - 6
+    return (int(period[1:]) - 1) * 365 // 12 + 1
+
+
+class Season:
+    """Columns for one rankings file, one entry per row in rank order."""
+
+    def __init__(self, year, gender, mtime, etag, period=""):
+        self.year = year
+        self.period = period
+        self.gender = gender
+        self.mtime = mtime
+        self.etag = etag
+        self.rank = array("i")
+        self.previous = array("i")
+        self.ittf_id = array("i")
+        self.points = array("i")
+        self.previous_points = array("i")
+        self.name = []
+        self.assoc = []
+        self._index = None
+
+    def __len__(self):
+        return len(self.rank)
+
+    @property
+    def index(self):
+        """Search indexes for this season, built the first time they are needed."""
+        if self._index is None:
+            self._index = SeasonIndex(self)
+        return self._index
+
+    def search(self, name=None, assoc=None, minpoints=None, maxpoints=None):
+        """Return the row numbers, in rank order, matching every filter given."""
+        matches = None
+
+        if name:
+            matches = self.index.name_prefix(name)
+
+        if assoc:
+            rows = set(self.index.association(assoc))
+            matches = rows if matches is None else matches & rows
+
+        if minpoints is not None or maxpoints is not None:
+            rows = set(self.index.points_between(minpoints, maxpoints))
+            matches = rows if matches is None else matches & rows
+
+        if matches is None:
+            return range(len(self))
+        return sorted(matches)
+
+    def row(self, i):
+        """Return row i as a Ranking."""
+        return Ranking(self.rank[i], self.previous[i], self.ittf_id[i], self.assoc[i],
+                       self.name[i], self.points[i], self.previous_points[i])
+
+    def top(self, n):
+        """Return a view of the first n rows without copying the columns."""
+        return self.slice(0, n)
+
+    def slice(self, start, stop):
+        """Return a view of rows start to stop without copying the columns."""
+        start = min(max(start, 0), len(self))
+        return RankingSlice(self, start, min(max(stop, start), len(self)))
+
+
+class SeasonIndex:
+    """Prebuilt lookups over one season's names, associations and points."""
+
+    def __init__(self, season):
+        # Every word of every name in sorted order, so "long" finds "MA Long"
+        words = sorted((word.lower(), i) for i, name in enumerate(season.name) for word in name.split())
+        self.words = [word for word, i in words]
+        self.word_rows = array("i", (i for word, i in words))
+
+        # Posting list of rows for each association, already in rank order
+        self.assocs = {}
+        for i, assoc in enumerate(season.assoc):
+            self.assocs.setdefault(assoc.upper(), array("i")).append(i)
+
+        # Rows sorted by points for range filters
+        order = sorted(range(len(season)), key=season.points.__getitem__)
+        self.points = array("i", (season.points[i] for i in order))
+        self.point_rows = array("i", order)
+
+    def word_prefix(self, prefix):
+        """Return the rows with a name word starting with prefix."""
+        rows = set()
+        for k in range(bisect_left(self.words, prefix), len(self.words)):
+            if not self.words[k].startswith(prefix):
+                break
+            rows.add(self.word_rows[k])
+        return rows
+
+    def name_prefix(self, name):
+        """Return the rows whose name has a word starting with each word searched for."""
+        rows = None
+        for prefix in name.lower().split():
+            found = self.word_prefix(prefix)
+            rows = found if rows is None else rows & found
+        return rows if rows is not None else set()
+
+    def association(self, assoc):
+        """Return the rows for one association."""
+        return self.assocs.get(assoc.strip().upper(), array("i"))
+
+    def points_between(self, low=None, high=None):
+        """Return the rows with points between low and high inclusive."""
+        start = 0 if low is None else bisect_left(self.points, low)
+        stop = len(self.points) if high is None else bisect_right(self.points, high)
+        return self.point_rows[start:stop]
+
+
+class RankingSlice:
+    """Read only window onto a season's columns."""
+
+    def __init__(self, season, start, stop):
+        self.season = season
+        self.start = start
+        self.stop = stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("ranking index out of range")
+        return self.season.row(self.start + i)
+
+    def __iter__(self):
+        for i in range(self.start, self.stop):
+            yield self.season.row(i)
+
+
+def load_season(path, year, gender, period=""):
+    """Parse one rankings csv into a Season."""
+    mtime = os.stat(path).st_mtime_ns
+    with open(path, "rb") as rankingcsv:
+        data = rankingcsv.read()
+
+    # Pages built from this file are tagged with a hash of its contents
+    season = Season(year, gender, mtime, hashlib.sha1(data).hexdigest()[:16], period)
+
+    for row in csv.DictReader(io.StringIO(data.decode("utf-8"), newline='')):
+        season.rank.append(to_int(row["Rank"]))
+        season.previous.append(to_int(row["Previous"]))
+        season.ittf_id.append(to_int(row["ID"]))
+        season.points.append(to_int(row["Points"]))
+        season.previous_points.append(to_int(row["Previous Points"]))
+
+        # Names and associations repeat across files so share one copy of each
+        season.name.append(sys.intern(row["Name"]))
+        season.assoc.append(sys.intern(row["Assoc"]))
+
+    return season
+
+
+class RankingsStore:
+    """Rankings files held in memory, keyed by (year, period, gender)."""
+
+    def __init__(self, directory=RANKINGS_DIR):
+        self.directory = directory
+        self._seasons = {}
+        self._lock = Lock()
+
+        # Folder listing, kept until the folder's modification time changes, and the period
+        # each older file without one in its name holds, keyed by (year, gender)
+        self._keys = None
+        self._listed = None
+        self._undated = {}
+
+        # ITTF player id -> {(year, period, gender): row number in that season}
+        self._careers = {}
+
+    def path(self, year, gender, period=""):
+        return os.path.join(self.directory, "{}{}{}.csv".format(year, period, gender))
+
+    def keys(self):
+        """Return the (year, period, gender) triples available on disk, oldest period first.
+
+        The folder is only listed again once a file is added or removed, so
+        a newly ingested period shows up without a restart.
+        """
+        listed = os.stat(self.directory).st_mtime_ns
+        if self._keys is None or self._listed != listed:
+            keys = []
+            undated = {}
+            for filename in os.listdir(self.directory):
+                match = FILENAME.match(filename)
+                if match:
+                    keys.append((int(match.group(1)), match.group(2) or "", match.group(3)))
+                    if not match.group(2):
+                        undated[(int(match.group(1)), match.group(3))] = file_period(os.path.join(self.directory, filename))
+            self._undated = undated
+            self._keys = sorted(keys, key=self.order)
+            self._listed = listed
+        return self._keys
+
+    def order(self, key):
+        """Return a sort key for a (year, period, gender) triple, placing older files by the period their rows give."""
+        year, period, gender = key
+        return year, period_order(period or self._undated.get((year, gender), "")), gender
+
+    def undated_period(self, year, gender):
+        """Return the period held by the year's older file without one in its name, or None if there is none."""
+        self.keys()
+        return self._undated.get((year, gender))
+
+    def years(self):
+        """Return every year with rankings in order."""
+        return sorted({year for year, period, gender in self.keys()})
+
+    def periods(self, year, gender):
+        """Return the periods held for one year and gender, oldest first."""
+        return [period for y, period, g in self.keys() if y == year and g == gender]
+
+    def previous(self, year, period, gender):
+        """Return the Season for the period before this one for gender, which may be in an earlier year, or None."""
+        keys = self.keys()
+        order = self.order((year, period, gender))
+        earlier = [(y, p) for y, p, g in keys if g == gender and self.order((y, p, g)) < order]
+        if not earlier:
+            return None
+        return self.get(earlier[-1][0], gender, earlier[-1][1])
+
+    def load_all(self, compiled=()):
+        """Load every rankings file, normally called once at startup.
+
+        compiled holds Seasons read from a snapshot. Each one is used while
+        its file is unchanged since it was compiled, other files are parsed.
+        """
+        with self._lock:
+            for season in compiled:
+                try:
+                    mtime = os.stat(self.path(season.year, season.gender, season.period)).st_mtime_ns
+                except OSError:
+                    continue
+                if mtime == season.mtime:
+                    key = (season.year, season.period, season.gender)
+                    old = self._seasons.get(key)
+                    self._seasons[key] = season
+                    self._index_careers(old, season)
+
+        for year, period, gender in self.keys():
+            self.get(year, gender, period)
+
+    def get(self, year, gender, period=None):
+        """Return the Season for a year, gender and period, or None if there is no file.
+
+        Without a period the year's latest is returned. A file is parsed
+        again only when its modification time changes.
+        """
+        try:
+            year = int(year)
+        except (TypeError, ValueError):
+            return None
+
+        if gender not in ("male", "female"):
+            return None
+
+        if period is None:
+            periods = self.periods(year, gender)
+            if not periods:
+                return None
+            period = periods[-1]
+        elif period and not PERIOD.match(period):
+            return None
+
+        path = self.path(year, gender, period)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+        key = (year, period, gender)
+        season = self._seasons.get(key)
+        if season is not None and season.mtime == mtime:
+            return season
+
+        with self._lock:
+            season = self._seasons.get(key)
+            if season is None or season.mtime != mtime:
+                old = season
+                season = load_season(path, year, gender, period)
+                self._seasons[key] = season
+                self._index_careers(old, season)
+            return season
+
+    def discard(self, year, gender, period=""):
+        """Forget a season whose file has been removed."""
+        with self._lock:
+            season = self._seasons.pop((year, period, gender), None)
+            if season is not None:
+                self._index_careers(season, None)
+
+    def _index_careers(self, old, new):
+        """Swap a reloaded season's rows into the player index, or take a discarded one's out if new is None."""
+        if old is not None:
+            key = (old.year, old.period, old.gender)
+            for ittf_id in old.ittf_id:
+                seasons = self._careers.get(ittf_id)
+                if seasons is not None:
+                    seasons.pop(key, None)
+                    if not seasons:
+                        del self._careers[ittf_id]
+
+        if new is not None:
+            key = (new.year, new.period, new.gender)
+            for i, ittf_id in enumerate(new.ittf_id):
+                self._careers.setdefault(ittf_id, {})[key] = i
+
+    def career(self, ittf_id):
+        """Return a player's ranking in every loaded period, oldest first.
+
+        Answered from the index built as files load, so no file is read and
+        the cost depends only on the number of periods.
+        """
+        with self._lock:
+            seasons = self._careers.get(ittf_id, {})
+            return [Career(year, period, gender, self._seasons[(year, period, gender)].row(i))
+                    for (year, period, gender), i in sorted(seasons.items(), key=lambda item: self.order(item[0]))]
+
+
+def ingest_rankings(store, lines, gender=None, replace=False):
+    """Stream one ITTF rankings csv into the store as a new period, returning its Season.
+
+    The period comes from the WeekNum, MonthNum and YearNum columns, which
+    must be the same on every row, and unless given the gender from the
+    Gender column most rows agree on, as ITTF files have the odd stray.
+    Rows are checked and counted into a temporary file, then Previous and
+    Previous Points are recomputed against the period before, already held
+    in memory, as that file is copied under its period's name. Neither the
+    upload nor any older file is read into memory. Older files named
+    without a period count as the period their rows give.
+    """
+    reader = csv.DictReader(lines)
+    missing = set(CSV_COLUMNS) - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError("missing columns: " + ", ".join(sorted(missing)))
+
+    fd, checked = tempfile.mkstemp(suffix=".tmp", dir=store.directory)
+    tmp = None
+    try:
+        votes = Counter()
+        with os.fdopen(fd, "w", newline="", encoding="utf-8") as out:
+            writer = csv.writer(out)
+            writer.writerow(CSV_COLUMNS)
+
+            for n, row in enumerate(reader, 2):
+                try:
+                    rank, ittf_id, points = int(row["Rank"]), int(row["ID"]), int(row["Points"])
+                    period = to_int(row["YearNum"]), to_int(row["WeekNum"]), to_int(row["MonthNum"])
+                except (TypeError, ValueError):
+                    raise ValueError("line {}: rank, id, points and period must be whole numbers".format(n))
+                if n == 2:
+                    year, week, month = period
+                    if not year or not period_name(week, month):
+                        raise ValueError("line 2: needs a year and a week or month")
+                elif period != (year, week, month):
+                    raise ValueError("line {}: every row must be for the same period".format(n))
+
+                votes[GENDERS.get(row["Gender"].strip().upper())] += 1
+                writer.writerow([rank, row["Previous"], ittf_id, row["Assoc"], row["Gender"], row["Name"], points, row["Previous Points"], week, month, year])
+
+        total = sum(votes.values())
+        if not total:
+            raise ValueError("no rankings in file")
+        period = period_name(week, month)
+
+        if gender is None:
+            gender, count = votes.most_common(1)[0]
+            if gender is None or count * 2 <= total:
+                raise ValueError("most rows need the same gender of M, F or W")
+
+        # An older file named without its period may already hold this one, replacing it removes that file
+        path = store.path(year, gender, period)
+        undated = store.undated_period(year, gender) == period
+        if (os.path.exists(path) or undated) and not replace:
+            raise ValueError("{} {} {} rankings are already in the store".format(year, period, gender))
+
+        # Rank and points per player in the period before, the file's own columns are kept when this is the first
+        previous = store.previous(year, period, gender)
+        if previous is not None:
+            before = dict(zip(previous.ittf_id, zip(previous.rank, previous.points)))
+
+        tmp = path + ".tmp"
+        with open(checked, newline="", encoding="utf-8") as rows, open(tmp, "w", newline="", encoding="utf-8") as out:
+            reader = csv.reader(rows)
+            writer = csv.writer(out)
+            writer.writerow(next(reader))
+            for row in reader:
+                if previous is not None:
+                    row[1], row[7] = before.get(int(row[2]), ("", ""))
+                writer.writerow(row)
+        os.replace(tmp, path)
+
+        if undated:
+            os.remove(store.path(year, gender))
+            store.discard(year, gender)
+    finally:
+        for leftover in (checked, tmp):
+            if leftover is not None and os.path.exists(leftover):
+                os.remove(leftover)
+
+    return store.get(year, gender, period)
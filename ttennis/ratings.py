@@ -0,0 +1,119 @@
+# Elo settings, every player starts at the same rating
+INITIAL_RATING = 1500
+K_FACTOR = 32
+
+
+def expected(rating, opponent):
+    """Return the chance of winning against opponent predicted by Elo."""
+    return 1 / (1 + 10 ** ((opponent - rating) / 400))
+
+
+def rate(ratings, result):
+    """Update ratings (name -> rating) for one result, returning both players' before and after."""
+    player1, player2 = result["player1"], result["player2"]
+    before1 = ratings.get(player1, INITIAL_RATING)
+    before2 = ratings.get(player2, INITIAL_RATING)
+
+    score = 1 if int(result["p1set"]) > int(result["p2set"]) else 0
+    change = K_FACTOR * (score - expected(before1, before2))
+
+    ratings[player1] = before1 + change
+    ratings[player2] = before2 - change
+    return (player1, before1, before1 + change), (player2, before2, before2 - change)
+
+
+def apply_ratings(db, results):
+    """Rate newly recorded results in date order, inside the caller's transaction.
+
+    results are dicts with id, date, player1, player2, p1set and p2set. Only
+    the players involved are read, so this costs the same however long the
+    history is. If one of them already has a rated result that comes after
+    the batch's first, everything from that date is replayed instead, so the
+    ratings match a rebuild.
+    """
+    if not results:
+        return
+
+    results = sorted(results, key=lambda result: (result["date"], result["id"]))
+    names = sorted({result["player1"] for result in results} | {result["player2"] for result in results})
+    rows = db.execute("SELECT id, name, rating FROM players WHERE name IN ({})".format(", ".join("?" * len(names))), *names)
+    ids = {row["name"]: row["id"] for row in rows}
+    ratings = {row["name"]: row["rating"] for row in rows}
+
+    first = results[0]
+    later = db.execute("SELECT 1 FROM rating_history WHERE player_id IN ({}) AND (date > ? OR (date = ? AND result_id > ?)) LIMIT 1".format(
+        ", ".join("?" * len(ids))), *ids.values(), first["date"], first["date"], first["id"])
+    if later:
+        replay_ratings(db, first["date"], results)
+        return
+
+    history = []
+    for result in results:
+        for name, before, after in rate(ratings, result):
+            history.append((result["id"], ids[name], result["date"], before, after))
+
+    db.executemany("INSERT INTO rating_history (result_id, player_id, date, rating_before, rating_after) VALUES (?, ?, ?, ?, ?)", history)
+    db.executemany("UPDATE players SET rating = ? WHERE id = ?", [(ratings[name], ids[name]) for name in names])
+
+
+def replay_ratings(db, since, pending=()):
+    """Re-rate every applied result dated since or later, with pending ones about to be marked applied.
+
+    Each player starts from their rating after their last result before
+    since, so the cost depends on how recent the date is rather than on the
+    whole history. Runs inside the caller's transaction and returns the
+    number of results replayed.
+    """
+    results = db.execute("SELECT id, date, player1, player2, p1set, p2set FROM results WHERE applied = 1 AND date >= ?", since)
+    results = sorted(results + list(pending), key=lambda result: (result["date"], result["id"]))
+
+    ids = {}
+    ratings = {}
+    for row in db.execute("SELECT id, name, (SELECT rating_after FROM rating_history WHERE player_id = players.id AND date < ? "
+                          "ORDER BY date DESC, result_id DESC LIMIT 1) AS rating FROM players", since):
+        ids[row["name"]] = row["id"]
+        if row["rating"] is not None:
+            ratings[row["name"]] = row["rating"]
+
+    # Players rated since then, including in results now edited away or voided, go back to their rating from before
+    touched = {row["player_id"] for row in db.execute("SELECT DISTINCT player_id FROM rating_history WHERE date >= ?", since)}
+
+    history = []
+    for result in results:
+        for name, before, after in rate(ratings, result):
+            if name in ids:
+                history.append((result["id"], ids[name], result["date"], before, after))
+                touched.add(ids[name])
+
+    names = {playerid: name for name, playerid in ids.items()}
+    db.execute("DELETE FROM rating_history WHERE date >= ?", since)
+    db.executemany("INSERT INTO rating_history (result_id, player_id, date, rating_before, rating_after) VALUES (?, ?, ?, ?, ?)", history)
+    db.executemany("UPDATE players SET rating = ? WHERE id = ?",
+                   [(ratings.get(names[playerid], INITIAL_RATING), playerid) for playerid in sorted(touched) if playerid in names])
+    return len(results)
+
+
+def rebuild_ratings(db):
+    """Replay every applied result in date order to recompute all ratings and their history.
+
+    The results are read in one streaming pass and written back with two
+    batched statements. Returns the number of results replayed.
+    """
+    ids = {row["name"]: row["id"] for row in db.execute("SELECT id, name FROM players")}
+    ratings = {}
+    history = []
+    replayed = 0
+
+    for result in db.iterate("SELECT id, date, player1, player2, p1set, p2set FROM results WHERE applied = 1 ORDER BY date, id"):
+        for name, before, after in rate(ratings, result):
+            if name in ids:
+                history.append((result["id"], ids[name], result["date"], before, after))
+        replayed += 1
+
+    with db.transaction():
+        db.execute("DELETE FROM rating_history")
+        db.executemany("INSERT INTO rating_history (result_id, player_id, date, rating_before, rating_after) VALUES (?, ?, ?, ?, ?)", history)
+        db.execute("UPDATE players SET rating = ?", INITIAL_RATING)
+        db.executemany("UPDATE players SET rating = ? WHERE id = ?", [(rating, ids[name]) for name, rating in ratings.items() if name in ids])
+
+    return replayed
@@ -0,0 +1,85 @@
+# Number of matches shown per page of results
+PAGE_SIZE = 25
+
+
+def make_cursor(row):
+    """Encode a result's position in the feed as date_id."""
+    return "{}_{}".format(row["date"], row["id"])
+
+
+def parse_cursor(cursor):
+    """Decode a cursor into (date, id), or None if it is malformed."""
+    date, _, id = str(cursor).rpartition("_")
+    if not date or not id.isdigit():
+        return None
+    return date, int(id)
+
+
+def results_query(leagueid=None, before=None, after=None, limit=None):
+    """Build the SQL and arguments for results on one side of a cursor.
+
+    Results run newest first from before, or oldest first from after.
+    """
+    query = "SELECT results.*, leagues.name AS leaguename FROM results JOIN leagues ON leagues.id = results.league_id"
+    where = []
+    args = []
+
+    if leagueid is not None:
+        where.append("results.league_id = ?")
+        args.append(leagueid)
+
+    if after is not None:
+        where.append("(results.date, results.id) > (?, ?)")
+        args.extend(after)
+        order = "ASC"
+    else:
+        if before is not None:
+            where.append("(results.date, results.id) < (?, ?)")
+            args.extend(before)
+        order = "DESC"
+
+    if where:
+        query += " WHERE " + " AND ".join(where)
+
+    query += " ORDER BY results.date {0}, results.id {0}".format(order)
+
+    if limit is not None:
+        query += " LIMIT ?"
+        args.append(limit)
+
+    return query, args
+
+
+def results_page(db, leagueid=None, before=None, after=None, limit=PAGE_SIZE):
+    """Return one page of results, newest first, with the league name joined in.
+
+    Pages are found with keyset pagination on (date, id): before gives the
+    page of older matches following a cursor and after the page of newer
+    matches preceding one, so each page costs the same however much history
+    there is. Returns (results, newer cursor, older cursor) with None for a
+    cursor when there is no page in that direction.
+    """
+    # Fetch one extra row to find out whether another page follows
+    query, args = results_query(leagueid, before, after, limit + 1)
+    results = db.execute(query, *args)
+    more = len(results) > limit
+    results = results[:limit]
+
+    if after is not None:
+        results.reverse()
+        newer = more
+        older = True
+    else:
+        newer = before is not None
+        older = more
+
+    if not results:
+        return results, None, None
+
+    return results, make_cursor(results[0]) if newer else None, make_cursor(results[-1]) if older else None
+
+
+def iter_results(db, leagueid=None, before=None):
+    """Yield every result older than before, newest first, without holding them in memory."""
+    query, args = results_query(leagueid, before)
+    return db.iterate(query, *args)
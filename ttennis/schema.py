@@ -0,0 +1,109 @@
+from ratings import INITIAL_RATING, rebuild_ratings
+from standings import rebuild_head_to_head, refresh_stats
+
+
+def migrate(db):
+    """Bring the database up to the current schema, safe to run more than once.
+
+    League standings used to live in one table per league named after the
+    league id ('15', '16', ...). Those tables are copied into the single
+    league_players table and dropped.
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS 'league_players' ('league_id' integer NOT NULL, 'player_id' integer NOT NULL, "
+               "'gamesplayed' int NOT NULL DEFAULT 0, 'gameswon' int NOT NULL DEFAULT 0, 'gameslost' int NOT NULL DEFAULT 0, "
+               "'pf' int NOT NULL DEFAULT 0, 'pa' int NOT NULL DEFAULT 0, 'pd' int NOT NULL DEFAULT 0, 'points' int NOT NULL DEFAULT 0, "
+               "PRIMARY KEY ('league_id', 'player_id'))")
+
+    # League tables are always read in points then pd order
+    db.execute("CREATE INDEX IF NOT EXISTS 'league_players_table' ON 'league_players' ('league_id', 'points' DESC, 'pd' DESC)")
+    db.execute("CREATE INDEX IF NOT EXISTS 'results_league_date' ON 'results' ('league_id', 'date')")
+    db.execute("CREATE INDEX IF NOT EXISTS 'results_date' ON 'results' ('date')")
+    db.execute("CREATE INDEX IF NOT EXISTS 'players_name' ON 'players' ('name')")
+
+    # Case insensitive name prefix searches for the player pickers
+    db.execute("CREATE INDEX IF NOT EXISTS 'players_name_nocase' ON 'players' ('name' COLLATE NOCASE)")
+
+    # Bumped whenever a result is recorded in the league, used for page ETags
+    columns = {row["name"] for row in db.execute("PRAGMA table_info('leagues')")}
+    if "version" not in columns:
+        db.execute("ALTER TABLE 'leagues' ADD COLUMN 'version' integer NOT NULL DEFAULT 0")
+
+    # Counters bumped by triggers whenever a table changes, so every process can tell its cached reads are stale
+    db.execute("CREATE TABLE IF NOT EXISTS 'data_versions' ('name' text PRIMARY KEY NOT NULL, 'version' integer NOT NULL DEFAULT 0)")
+    db.execute("INSERT OR IGNORE INTO data_versions (name) VALUES ('players')")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        db.execute("CREATE TRIGGER IF NOT EXISTS 'players_{}_version' AFTER {} ON 'players' "
+                   "BEGIN UPDATE data_versions SET version = version + 1 WHERE name = 'players'; END".format(event.lower(), event))
+
+    # Results are recorded unapplied and a queued job applies them to the derived tables below
+    columns = {row["name"] for row in db.execute("PRAGMA table_info('results')")}
+    if "applied" not in columns:
+        db.execute("ALTER TABLE 'results' ADD COLUMN 'applied' integer NOT NULL DEFAULT 1")
+    db.execute("DROP INDEX IF EXISTS 'results_pending'")
+    db.execute("CREATE INDEX IF NOT EXISTS 'results_unapplied' ON 'results' ('league_id', 'id') WHERE applied = 0")
+    db.execute("CREATE TABLE IF NOT EXISTS 'jobs' ('id' integer PRIMARY KEY AUTOINCREMENT NOT NULL, 'kind' text NOT NULL, 'key' text NOT NULL, "
+               "'created' real NOT NULL, 'run_after' real NOT NULL DEFAULT 0, 'attempts' int NOT NULL DEFAULT 0, 'error' text, "
+               "UNIQUE ('kind', 'key'))")
+
+    # Append only log of every result recorded, edited or voided, with its values after the change
+    db.execute("CREATE TABLE IF NOT EXISTS 'match_events' ('id' integer PRIMARY KEY AUTOINCREMENT NOT NULL, 'result_id' integer NOT NULL, "
+               "'league_id' integer NOT NULL, 'action' text NOT NULL, 'user_id' integer, 'created' datetime NOT NULL, 'data' text NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS 'match_events_result' ON 'match_events' ('result_id')")
+
+    # Each player's latest results, for recomputing form after a result changes
+    db.execute("CREATE INDEX IF NOT EXISTS 'results_player1' ON 'results' ('player1', 'date')")
+    db.execute("CREATE INDEX IF NOT EXISTS 'results_player2' ON 'results' ('player2', 'date')")
+
+    # Elo rating per player plus the change each result made to it
+    db.execute("CREATE TABLE IF NOT EXISTS 'rating_history' ('result_id' integer NOT NULL, 'player_id' integer NOT NULL, 'date' date NOT NULL, "
+               "'rating_before' real NOT NULL, 'rating_after' real NOT NULL, PRIMARY KEY ('result_id', 'player_id'))")
+    db.execute("CREATE INDEX IF NOT EXISTS 'rating_history_player' ON 'rating_history' ('player_id', 'date')")
+
+    # Corrections replay ratings from the changed result's date onward
+    db.execute("CREATE INDEX IF NOT EXISTS 'rating_history_date' ON 'rating_history' ('date')")
+
+    columns = {row["name"] for row in db.execute("PRAGMA table_info('players')")}
+    if "rating" not in columns:
+        db.execute("ALTER TABLE 'players' ADD COLUMN 'rating' real NOT NULL DEFAULT {}".format(INITIAL_RATING))
+        rebuild_ratings(db)
+    db.execute("CREATE INDEX IF NOT EXISTS 'players_rating' ON 'players' ('rating' DESC)")
+
+    # Record of every pair of players in a league, stored from both players' side
+    tables = {row["name"] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    db.execute("CREATE TABLE IF NOT EXISTS 'head_to_head' ('league_id' integer NOT NULL, 'player_id' integer NOT NULL, 'opponent_id' integer NOT NULL, "
+               "'played' int NOT NULL DEFAULT 0, 'won' int NOT NULL DEFAULT 0, 'lost' int NOT NULL DEFAULT 0, "
+               "'sets_for' int NOT NULL DEFAULT 0, 'sets_against' int NOT NULL DEFAULT 0, 'pf' int NOT NULL DEFAULT 0, 'pa' int NOT NULL DEFAULT 0, "
+               "PRIMARY KEY ('league_id', 'player_id', 'opponent_id'))")
+    if "head_to_head" not in tables:
+        rebuild_head_to_head(db)
+
+    # Totals and recent form per player across every league
+    db.execute("CREATE TABLE IF NOT EXISTS 'player_stats' ('player_id' integer PRIMARY KEY NOT NULL, 'matches' int NOT NULL DEFAULT 0, "
+               "'wins' int NOT NULL DEFAULT 0, 'sets_won' int NOT NULL DEFAULT 0, 'sets_lost' int NOT NULL DEFAULT 0, 'games_played' int NOT NULL DEFAULT 0, "
+               "'points_won' int NOT NULL DEFAULT 0, 'points_lost' int NOT NULL DEFAULT 0, 'deciders' int NOT NULL DEFAULT 0, "
+               "'deciders_won' int NOT NULL DEFAULT 0, 'form' text NOT NULL DEFAULT '')")
+    if "player_stats" not in tables:
+        refresh_stats(db)
+
+    # Move any old per league tables across
+    leagues = db.execute("SELECT id FROM leagues")
+    tables = {row["name"] for row in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    for league in leagues:
+        table = str(league["id"])
+        if table not in tables:
+            continue
+
+        with db.transaction():
+            # Refuse to drop standings for players that cannot be matched
+            missing = db.execute("SELECT COUNT(*) AS n FROM \"{}\" t LEFT JOIN players ON players.name = t.playername "
+                                 "WHERE players.id IS NULL".format(table))
+            if missing[0]["n"]:
+                raise RuntimeError("league {} has players missing from the players table".format(table))
+
+            db.execute("INSERT INTO league_players (league_id, player_id, gamesplayed, gameswon, gameslost, pf, pa, pd, points) "
+                       "SELECT ?, players.id, t.gamesplayed, t.gameswon, t.gameslost, t.pf, t.pa, t.pd, t.points "
+                       "FROM \"{}\" t JOIN players ON players.name = t.playername".format(table), league["id"])
+
+            db.execute("DROP TABLE \"{}\"".format(table))
+            db.execute("UPDATE leagues SET version = version + 1 WHERE id = ?", league["id"])
@@ -0,0 +1,137 @@
+import mmap
+import os
+import struct
+import sys
+
+from array import array
+
+from rankings import RANKINGS_DIR, Season
+
+# Compiled copy of every rankings file, written by `flask compile-rankings`
+SNAPSHOT_FILE = os.path.join(RANKINGS_DIR, "rankings.snapshot")
+
+# Header: magic, format version, byte order marker, number of seasons, number of strings
+MAGIC = b"TTRK"
+VERSION = 2
+BYTE_ORDER = 0x01020304
+HEADER = struct.Struct("=4sIIII")
+
+# One per season: year, period and gender string ids, etag, source mtime, rows, offset of its columns
+ENTRY = struct.Struct("=iII16sqIQ")
+
+# Every column is stored as 32 bit ints, names and associations as string table ids
+COLUMNS = ["rank", "previous", "ittf_id", "points", "previous_points", "name", "assoc"]
+STRING_COLUMNS = ("name", "assoc")
+
+
+class StringColumn:
+    """Read only list of strings held as ids into a shared string table."""
+
+    def __init__(self, ids, strings):
+        self.ids = ids
+        self.strings = strings
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.strings[self.ids[i]]
+
+    def __iter__(self):
+        for i in self.ids:
+            yield self.strings[i]
+
+
+def align(offset, size=8):
+    """Round offset up to a multiple of size."""
+    return -(-offset // size) * size
+
+
+def write_snapshot(path, seasons):
+    """Write seasons to path as one columnar file, replacing any old snapshot atomically."""
+    ids = {}
+    for season in seasons:
+        ids.setdefault(season.period, len(ids))
+        ids.setdefault(season.gender, len(ids))
+        for column in STRING_COLUMNS:
+            for value in getattr(season, column):
+                ids.setdefault(value, len(ids))
+
+    blobs = [value.encode("utf-8") for value in ids]
+    offsets = array("I", [0])
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+
+    # Columns start after the header, string table and season entries
+    position = align(HEADER.size + offsets.itemsize * len(offsets) + offsets[-1]) + ENTRY.size * len(seasons)
+    position = align(position)
+
+    entries = []
+    columns = []
+    for season in seasons:
+        entries.append(ENTRY.pack(season.year, ids[season.period], ids[season.gender], season.etag.encode("ascii"), season.mtime, len(season), position))
+        for column in COLUMNS:
+            values = getattr(season, column)
+            if column in STRING_COLUMNS:
+                values = (ids[value] for value in values)
+            data = array("i", values).tobytes()
+            columns.append(data)
+            position += len(data)
+
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER, len(seasons), len(blobs)))
+        file.write(offsets.tobytes())
+        file.write(b"".join(blobs))
+        file.write(b"\0" * (align(file.tell()) - file.tell()))
+        file.write(b"".join(entries))
+        file.write(b"\0" * (align(file.tell()) - file.tell()))
+        file.write(b"".join(columns))
+
+    # Workers still mapping the old file keep reading it until they reload
+    os.replace(tmp, path)
+
+
+def read_snapshot(path=SNAPSHOT_FILE):
+    """Map a snapshot read only and return its Seasons, or [] if it is missing or unreadable.
+
+    The numeric columns are memoryviews straight onto the mapped file, so
+    processes loading the same snapshot share its pages and nothing is parsed.
+    Only the string table is decoded.
+    """
+    try:
+        with open(path, "rb") as file:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return []
+
+    try:
+        return list(load_seasons(memoryview(data)))
+    except (struct.error, ValueError, IndexError, TypeError):
+        return []
+
+
+def load_seasons(view):
+    """Yield the Seasons in a mapped snapshot."""
+    magic, version, byte_order, count, nstrings = HEADER.unpack_from(view, 0)
+    if magic != MAGIC or version != VERSION or byte_order != BYTE_ORDER:
+        return
+
+    position = HEADER.size
+    offsets = view[position:position + 4 * (nstrings + 1)].cast("I")
+    position += offsets.nbytes
+    strings = [sys.intern(str(view[position + offsets[i]:position + offsets[i + 1]], "utf-8")) for i in range(nstrings)]
+    position = align(position + offsets[nstrings])
+
+    for n in range(count):
+        year, period, gender, etag, mtime, rows, offset = ENTRY.unpack_from(view, position + n * ENTRY.size)
+        season = Season(year, strings[gender], mtime, etag.decode("ascii"), strings[period])
+
+        size = 4 * rows
+        for c, column in enumerate(COLUMNS):
+            values = view[offset + c * size:offset + (c + 1) * size].cast("i")
+            if len(values) != rows:
+                raise ValueError("snapshot is truncated")
+            setattr(season, column, StringColumn(values, strings) if column in STRING_COLUMNS else values)
+
+        yield season
@@ -0,0 +1,572 @@
+import csv
+import io
+import json
+import logging
+import sqlite3
+
+from jobs import enqueue
+from ratings import apply_ratings
+
+# Job that applies a league's newly recorded results to every derived table
+APPLY_RESULTS = "apply_results"
+
+# Values of results.applied: waiting for its job, counted in every derived table, or left out
+# because applying it failed, until it is edited or voided
+PENDING = 0
+APPLIED = 1
+FAILED = -1
+
+# Jobs recomputing what depends on the order of results after one is edited or voided, ratings
+# keyed by the date to replay them from
+REFRESH_FORM = "refresh_form"
+REBUILD_RATINGS = "rebuild_ratings"
+
+logger = logging.getLogger(__name__)
+
+# Columns of the results table, also the field names accepted by bulk imports
+RESULT_COLUMNS = ["league_id", "date", "player1", "player2", "p1set", "p2set",
+                  "p1g1", "p2g1", "p1g2", "p2g2", "p1g3", "p2g3", "p1g4", "p2g4", "p1g5", "p2g5"]
+
+# Look up a player id by name inside a statement
+PLAYER_ID = "(SELECT id FROM players WHERE name = :{})"
+
+# Points won by each player in a result, counting only games both players scored in
+POINTS = " + ".join("(CASE WHEN p1g{0} != '' AND p2g{0} != '' THEN p{{0}}g{0} ELSE 0 END)".format(g) for g in range(1, 6))
+
+# Games both players scored in, and whether the fifth game was needed
+PLAYED = " + ".join("(CASE WHEN p1g{0} != '' AND p2g{0} != '' THEN 1 ELSE 0 END)".format(g) for g in range(1, 6))
+DECIDER = "(CASE WHEN p1g5 != '' AND p2g5 != '' THEN 1 ELSE 0 END)"
+
+# Every applied result once from each player's side
+RESULT_SIDES = ("SELECT id, date, league_id, player1 AS name, p1set > p2set AS won, p1set AS sets_won, p2set AS sets_lost, "
+                "{played} AS games, {decider} AS decider, {p1} AS pf, {p2} AS pa FROM results WHERE applied = 1 "
+                "UNION ALL SELECT id, date, league_id, player2, p2set > p1set, p2set, p1set, {played}, {decider}, {p2}, {p1} FROM results WHERE applied = 1").format(
+                    played=PLAYED, decider=DECIDER, p1=POINTS.format(1), p2=POINTS.format(2))
+
+# Counters kept by apply_results(), in the order rebuild_standings() reports them
+PLAYER_COUNTERS = ["games", "wins", "losses", "winratio"]
+LEAGUE_COUNTERS = ["gamesplayed", "gameswon", "gameslost", "pf", "pa", "pd", "points"]
+
+# Totals kept in player_stats, plus form as W/L letters for the latest FORM_LENGTH matches, newest first
+STAT_COLUMNS = ["matches", "wins", "sets_won", "sets_lost", "games_played", "points_won", "points_lost", "deciders", "deciders_won"]
+FORM_LENGTH = 10
+
+
+def game_score(value):
+    """Convert a submitted game score, treating unplayed games as blank."""
+    if value is None or str(value).strip() == '':
+        return ''
+    return int(value)
+
+
+def points_for(games):
+    """Return total points won by player 1 and player 2 over the games played."""
+    p1pf = sum(p1 for p1, p2 in games if p1 != '' and p2 != '')
+    p1pa = sum(p2 for p1, p2 in games if p1 != '' and p2 != '')
+    return p1pf, p1pa
+
+
+def head_to_head_deltas(deltas, leagueid, player1, player2, p1sets, p2sets, p1pf, p1pa):
+    """Add a match to deltas, keyed (league, player, opponent), once from each player's side.
+
+    Each value is [played, won, lost, sets for, sets against, pf, pa].
+    """
+    for player, opponent, won, sf, sa, pf, pa in [(player1, player2, p1sets > p2sets, p1sets, p2sets, p1pf, p1pa),
+                                                  (player2, player1, p2sets > p1sets, p2sets, p1sets, p1pa, p1pf)]:
+        pair = deltas.setdefault((str(leagueid), player, opponent), [0, 0, 0, 0, 0, 0, 0])
+        pair[0] += 1
+        pair[1 if won else 2] += 1
+        pair[3] += sf
+        pair[4] += sa
+        pair[5] += pf
+        pair[6] += pa
+    return deltas
+
+
+def apply_head_to_head(db, deltas):
+    """Add head to head deltas to their pairs, creating pairs meeting for the first time."""
+    db.executemany("INSERT INTO head_to_head (league_id, player_id, opponent_id, played, won, lost, sets_for, sets_against, pf, pa) "
+                   "VALUES (?, (SELECT id FROM players WHERE name = ?), (SELECT id FROM players WHERE name = ?), ?, ?, ?, ?, ?, ?, ?) "
+                   "ON CONFLICT (league_id, player_id, opponent_id) DO UPDATE SET played = played + excluded.played, "
+                   "won = won + excluded.won, lost = lost + excluded.lost, sets_for = sets_for + excluded.sets_for, "
+                   "sets_against = sets_against + excluded.sets_against, pf = pf + excluded.pf, pa = pa + excluded.pa",
+                   [(leagueid, player, opponent, *delta) for (leagueid, player, opponent), delta in deltas.items()])
+
+
+def rebuild_head_to_head(db):
+    """Recompute every head to head record from the results table, returning the number of pairs."""
+    deltas = {}
+    for row in db.iterate("SELECT * FROM results WHERE applied = 1"):
+        games = [(game_score(row["p1g" + str(g)]), game_score(row["p2g" + str(g)])) for g in range(1, 6)]
+        head_to_head_deltas(deltas, row["league_id"], row["player1"], row["player2"], int(row["p1set"]), int(row["p2set"]), *points_for(games))
+
+    with db.transaction():
+        db.execute("DELETE FROM head_to_head")
+        apply_head_to_head(db, deltas)
+        db.execute("UPDATE leagues SET version = version + 1")
+
+    return len(deltas)
+
+
+def stats_deltas(deltas, player1, player2, p1sets, p2sets, games):
+    """Add a match to deltas, keyed by player name, in STAT_COLUMNS order followed by form."""
+    played = sum(1 for p1, p2 in games if p1 != '' and p2 != '')
+    decider = games[4][0] != '' and games[4][1] != ''
+    p1pf, p1pa = points_for(games)
+
+    for name, won, sf, sa, pf, pa in [(player1, p1sets > p2sets, p1sets, p2sets, p1pf, p1pa),
+                                      (player2, p2sets > p1sets, p2sets, p1sets, p1pa, p1pf)]:
+        stats = deltas.setdefault(name, [0, 0, 0, 0, 0, 0, 0, 0, 0, ""])
+        for i, value in enumerate([1, won, sf, sa, played, pf, pa, decider, decider and won]):
+            stats[i] += int(value)
+
+        # Later matches go in front
+        stats[9] = ("W" if won else "L") + stats[9]
+    return deltas
+
+
+def apply_stats(db, deltas):
+    """Add stats deltas to each player's row, creating it for a player's first match."""
+    db.executemany("INSERT INTO player_stats (player_id, {0}, form) VALUES ((SELECT id FROM players WHERE name = ?), {1}, substr(?, 1, {2})) "
+                   "ON CONFLICT (player_id) DO UPDATE SET {3}, form = substr(excluded.form || form, 1, {2})".format(
+                       ", ".join(STAT_COLUMNS), ", ".join("?" * len(STAT_COLUMNS)), FORM_LENGTH,
+                       ", ".join("{0} = {0} + excluded.{0}".format(column) for column in STAT_COLUMNS)),
+                   [(name, *stats) for name, stats in deltas.items()])
+
+
+def refresh_stats(db):
+    """Recompute player_stats for every player from the results table, returning the number of players.
+
+    Totals come from one GROUP BY over the results read from both sides and
+    form from a window over each player's latest matches. Applying results
+    keeps both current, this repairs the table after it is edited by hand.
+    """
+    with db.transaction():
+        db.execute("DROP TABLE IF EXISTS temp.side")
+        db.execute("CREATE TEMP TABLE side AS " + RESULT_SIDES)
+        db.execute("CREATE INDEX temp.side_name ON side (name, date)")
+
+        db.execute("DELETE FROM player_stats")
+        db.execute("INSERT INTO player_stats (player_id, matches, wins, sets_won, sets_lost, games_played, points_won, points_lost, deciders, deciders_won, form) "
+                   "SELECT players.id, COUNT(side.name), COALESCE(SUM(side.won), 0), COALESCE(SUM(side.sets_won), 0), COALESCE(SUM(side.sets_lost), 0), "
+                   "COALESCE(SUM(side.games), 0), COALESCE(SUM(side.pf), 0), COALESCE(SUM(side.pa), 0), COALESCE(SUM(side.decider), 0), "
+                   "COALESCE(SUM(side.decider AND side.won), 0), '' FROM players LEFT JOIN side ON side.name = players.name GROUP BY players.id")
+
+        forms = {}
+        for row in db.iterate("SELECT name, won FROM (SELECT name, won, ROW_NUMBER() OVER (PARTITION BY name ORDER BY date DESC, id DESC) AS n FROM side) "
+                              "WHERE n <= ? ORDER BY name, n", FORM_LENGTH):
+            forms[row["name"]] = forms.get(row["name"], "") + ("W" if row["won"] else "L")
+        db.executemany("UPDATE player_stats SET form = ? WHERE player_id = (SELECT id FROM players WHERE name = ?)",
+                       [(form, name) for name, form in forms.items()])
+
+        db.execute("DROP TABLE temp.side")
+        return db.execute("SELECT COUNT(*) AS n FROM player_stats")[0]["n"]
+
+
+def validate_match(p1sets, p2sets, games, date):
+    """Return the reason a match breaks the best of 5 rules, or None if it is valid."""
+
+    # Case for when not enough sets played
+    if p1sets != 3 and p2sets != 3:
+        return "matches must be best of 5 sets"
+
+    # Case for when sets entered correctly but not enough games
+    if not games[2][0] and not games[2][1]:
+        return "matches must be best of 5 sets"
+
+    if p1sets < 0 or p2sets < 0:
+        return "cannot record negative set number"
+
+    # Case for scores being equal
+    if p1sets == p2sets:
+        return "game must have a winner"
+
+    if not date:
+        return "no date provided"
+
+    return None
+
+
+def check_players(db, leagueid, player1, player2):
+    """Raise ValueError unless player1 and player2 are two different players entered in the league."""
+    if player1 == player2:
+        raise ValueError("cannot play a match with one player")
+
+    entered = db.execute("SELECT COUNT(*) AS n FROM league_players JOIN players ON players.id = league_players.player_id "
+                         "WHERE league_players.league_id = ? AND players.name IN (?, ?)", leagueid, player1, player2)[0]["n"]
+    if entered != 2:
+        raise ValueError("both players must be in the league")
+
+
+def record_match(db, leagueid, date, player1, player2, p1sets, p2sets, games, userid=None):
+    """Record one match and queue its derived updates, returning the new result's id.
+
+    games is a list of five (player 1, player 2) scores with '' for unplayed games.
+    The result row goes in unapplied alongside a job for its league, so the
+    scorer only waits for one small transaction. apply_pending() then updates
+    the standings, head to head records, stats and ratings. The match is
+    logged as recorded by userid. Raises ValueError if the players are not
+    both in the league.
+    """
+    games = [(game_score(p1), game_score(p2)) for p1, p2 in games]
+
+    with db.transaction():
+        check_players(db, leagueid, player1, player2)
+        id = db.execute("INSERT INTO results (league_id, date, player1, player2, p1set, p2set, p1g1, p2g1, p1g2, p2g2, p1g3, p2g3, p1g4, p2g4, p1g5, p2g5, applied) "
+                        "VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                        leagueid, date, player1, player2, p1sets, p2sets, *[score for game in games for score in game])
+
+        log_events(db, "record", userid, "id = ?", id)
+
+        # The results page changes now, the standings once the job runs
+        db.execute("UPDATE leagues SET version = version + 1 WHERE id = ?", leagueid)
+        enqueue(db, APPLY_RESULTS, leagueid)
+
+    return id
+
+
+def log_events(db, action, userid, where, *args):
+    """Append an event for each result matching where, holding its values at that point."""
+    db.execute("INSERT INTO match_events (result_id, league_id, action, user_id, created, data) "
+               "SELECT id, league_id, ?, ?, datetime('now'), json_object({}) FROM results WHERE {}".format(
+                   ", ".join("'{0}', {0}".format(column) for column in RESULT_COLUMNS), where),
+               action, userid, *args)
+
+
+def apply_results(db, results, sign=1):
+    """Apply result rows to players, league tables, head to head records and stats.
+
+    Runs inside the caller's transaction. Deltas are accumulated so each
+    player and league table row is only written once however many results
+    there are. With sign -1 the results are taken back out, except from
+    form, which like ratings depends on order and is left to a job.
+    """
+    playerdeltas = {}
+    leaguedeltas = {}
+    pairdeltas = {}
+    statsdeltas = {}
+
+    for result in results:
+        leagueid, player1, player2 = str(result["league_id"]), result["player1"], result["player2"]
+        p1sets, p2sets = int(result["p1set"]), int(result["p2set"])
+        games = [(game_score(result["p1g" + str(g)]), game_score(result["p2g" + str(g)])) for g in range(1, 6)]
+
+        p1pf, p1pa = points_for(games)
+        head_to_head_deltas(pairdeltas, leagueid, player1, player2, p1sets, p2sets, p1pf, p1pa)
+        stats_deltas(statsdeltas, player1, player2, p1sets, p2sets, games)
+        for name, won, pf, pa in [(player1, p1sets > p2sets, p1pf, p1pa), (player2, p2sets > p1sets, p1pa, p1pf)]:
+            player = playerdeltas.setdefault(name, [0, 0, 0])
+            player[0] += 1
+            player[1 if won else 2] += 1
+
+            league = leaguedeltas.setdefault(leagueid, {}).setdefault(name, [0, 0, 0, 0, 0, 0])
+            league[0] += 1
+            league[1 if won else 2] += 1
+            league[3] += pf
+            league[4] += pa
+            league[5] += 3 if won else 0
+
+    if sign < 0:
+        for deltas in [playerdeltas, pairdeltas, *leaguedeltas.values()]:
+            for key, delta in deltas.items():
+                deltas[key] = [-value for value in delta]
+        for name, stats in statsdeltas.items():
+            statsdeltas[name] = [-value for value in stats[:-1]] + [""]
+
+    db.executemany("UPDATE players SET games = games + ?, wins = wins + ?, losses = losses + ?, "
+                   "winratio = CASE WHEN wins + losses + ? THEN ROUND(CAST(wins + ? AS REAL) / (wins + losses + ?), 2) ELSE 0 END WHERE name = ?",
+                   [(games, wins, losses, games, wins, games, name) for name, (games, wins, losses) in playerdeltas.items()])
+
+    db.executemany("UPDATE league_players SET gamesplayed = gamesplayed + ?, gameswon = gameswon + ?, gameslost = gameslost + ?, "
+                   "pf = pf + ?, pa = pa + ?, pd = pf + ? - pa - ?, points = points + ? "
+                   "WHERE league_id = ? AND player_id = (SELECT id FROM players WHERE name = ?)",
+                   [(games, won, lost, pf, pa, pf, pa, points, leagueid, name)
+                    for leagueid, deltas in leaguedeltas.items() for name, (games, won, lost, pf, pa, points) in deltas.items()])
+
+    apply_head_to_head(db, pairdeltas)
+    apply_stats(db, statsdeltas)
+
+    # Pairs whose only meetings were taken out
+    if sign < 0:
+        db.executemany("DELETE FROM head_to_head WHERE league_id = ? AND player_id = (SELECT id FROM players WHERE name = ?) "
+                       "AND opponent_id = (SELECT id FROM players WHERE name = ?) AND played = 0", list(pairdeltas))
+
+    db.executemany("UPDATE leagues SET version = version + 1 WHERE id = ?", [(leagueid,) for leagueid in leaguedeltas])
+
+
+def apply_pending(db, leagueid):
+    """Apply every pending result in a league, returning the ones applied oldest first.
+
+    Run by the job queue inside its transaction. Results are marked applied
+    in the same transaction, so running again, or after a failure, never
+    counts a result twice. If the batch breaks a constraint each result is
+    tried on its own, and any that still fail are marked FAILED so they
+    cannot hold up the rest of the league. Players the batch reaches out of
+    date order have their form queued to be recomputed.
+    """
+    results = db.execute("SELECT * FROM results WHERE league_id = ? AND applied = ? ORDER BY id", leagueid, PENDING)
+    if not results:
+        return results
+
+    try:
+        with db.savepoint():
+            apply_results(db, results)
+            apply_ratings(db, results)
+        applied = results
+    except sqlite3.IntegrityError:
+        applied = []
+        for result in results:
+            try:
+                with db.savepoint():
+                    apply_results(db, [result])
+                    apply_ratings(db, [result])
+                applied.append(result)
+            except sqlite3.IntegrityError:
+                logger.exception("result %s could not be applied", result["id"])
+                db.execute("UPDATE results SET applied = ? WHERE id = ?", FAILED, result["id"])
+
+    for name in backdated_players(db, applied):
+        enqueue(db, REFRESH_FORM, name)
+    db.executemany("UPDATE results SET applied = ? WHERE id = ?", [(APPLIED, result["id"]) for result in applied])
+    return applied
+
+
+def backdated_players(db, results):
+    """Return the players whose form the results, still unmarked, were added to out of date order.
+
+    Form is extended in the order results are applied, which is only right
+    while each is dated no earlier than the player's results before it.
+    """
+    batches = {}
+    for result in results:
+        for name in (result["player1"], result["player2"]):
+            batches.setdefault(name, []).append(result["date"])
+    if not batches:
+        return []
+
+    marks = ", ".join("?" * len(batches))
+    latest = {row["name"]: row["date"] for row in db.execute(
+        "SELECT name, MAX(date) AS date FROM (SELECT player1 AS name, date FROM results WHERE applied = 1 AND player1 IN ({0}) "
+        "UNION ALL SELECT player2, date FROM results WHERE applied = 1 AND player2 IN ({0})) GROUP BY name".format(marks),
+        *batches, *batches)}
+
+    return sorted(name for name, dates in batches.items()
+                  if dates != sorted(dates) or (name in latest and dates[0] < latest[name]))
+
+
+def reorder_jobs(db, results):
+    """Queue the form of every player in results, and ratings from the earliest of their dates, to be recomputed."""
+    for name in sorted({result["player1"] for result in results} | {result["player2"] for result in results}):
+        enqueue(db, REFRESH_FORM, name)
+    enqueue(db, REBUILD_RATINGS, min(result["date"] for result in results))
+
+
+def edit_result(db, resultid, userid, date, player1, player2, p1sets, p2sets, games):
+    """Correct a recorded result, returning its values from before or None if there is no such result.
+
+    The old values are taken back out of every counter and the new ones
+    added in one transaction, so nothing is recomputed from scratch. A
+    result still waiting for its job is simply changed before it applies,
+    and one that failed to apply is queued again. Raises ValueError if the
+    players are not both in the league.
+    """
+    games = [(game_score(p1), game_score(p2)) for p1, p2 in games]
+
+    with db.transaction():
+        rows = db.execute("SELECT * FROM results WHERE id = ?", resultid)
+        if not rows:
+            return None
+        old = rows[0]
+        check_players(db, old["league_id"], player1, player2)
+
+        if old["applied"] == APPLIED:
+            apply_results(db, [old], sign=-1)
+
+        db.execute("UPDATE results SET date = ?, player1 = ?, player2 = ?, p1set = ?, p2set = ?, p1g1 = ?, p2g1 = ?, p1g2 = ?, p2g2 = ?, "
+                   "p1g3 = ?, p2g3 = ?, p1g4 = ?, p2g4 = ?, p1g5 = ?, p2g5 = ? WHERE id = ?",
+                   date, player1, player2, p1sets, p2sets, *[score for game in games for score in game], resultid)
+        new = db.execute("SELECT * FROM results WHERE id = ?", resultid)[0]
+
+        if old["applied"] == APPLIED:
+            apply_results(db, [new])
+            reorder_jobs(db, [old, new])
+        elif old["applied"] == FAILED:
+            db.execute("UPDATE results SET applied = ? WHERE id = ?", PENDING, resultid)
+            enqueue(db, APPLY_RESULTS, old["league_id"])
+
+        log_events(db, "edit", userid, "id = ?", resultid)
+        db.execute("UPDATE leagues SET version = version + 1 WHERE id = ?", old["league_id"])
+
+    return old
+
+
+def void_result(db, resultid, userid):
+    """Remove a recorded result, returning it or None if there is no such result.
+
+    Its last values stay in the event log and it is taken back out of every
+    counter in the same transaction.
+    """
+    with db.transaction():
+        rows = db.execute("SELECT * FROM results WHERE id = ?", resultid)
+        if not rows:
+            return None
+        old = rows[0]
+
+        log_events(db, "void", userid, "id = ?", resultid)
+
+        if old["applied"] == APPLIED:
+            apply_results(db, [old], sign=-1)
+            reorder_jobs(db, [old])
+
+        # Its rating history is left for the ratings job, which resets everyone it rated
+        db.execute("DELETE FROM results WHERE id = ?", resultid)
+        db.execute("UPDATE leagues SET version = version + 1 WHERE id = ?", old["league_id"])
+
+    return old
+
+
+def refresh_form(db, name):
+    """Recompute one player's form from their latest applied results."""
+    form = "".join("W" if row["won"] else "L" for row in db.execute(
+        "SELECT won FROM (SELECT date, id, p1set > p2set AS won FROM results WHERE applied = 1 AND player1 = :name "
+        "UNION ALL SELECT date, id, p2set > p1set FROM results WHERE applied = 1 AND player2 = :name) "
+        "ORDER BY date DESC, id DESC LIMIT :n", name=name, n=FORM_LENGTH))
+    db.execute("UPDATE player_stats SET form = ? WHERE player_id = (SELECT id FROM players WHERE name = ?)", form, name)
+
+
+def rebuild_standings(db, repair=True):
+    """Recompute every player's and league table's counters from the results table.
+
+    The expected values come from a handful of GROUP BY queries over the
+    results, read once from each player's side, and are compared and written
+    back set at a time. Returns (players, league rows, strays): the rows whose
+    counters were wrong, with the stored and expected values, and the
+    results naming a player who is not in that league's table. Nothing is
+    written unless repair is set.
+    """
+    with db.transaction():
+        for table in ["side", "expected_players", "expected_league"]:
+            db.execute("DROP TABLE IF EXISTS temp.{}".format(table))
+
+        db.execute("CREATE TEMP TABLE side AS " + RESULT_SIDES)
+        db.execute("CREATE INDEX temp.side_player ON side (name, league_id)")
+
+        db.execute("CREATE TEMP TABLE expected_players AS SELECT players.id AS player_id, COUNT(side.name) AS games, "
+                   "COALESCE(SUM(side.won), 0) AS wins, COUNT(side.name) - COALESCE(SUM(side.won), 0) AS losses, "
+                   "CASE WHEN COUNT(side.name) THEN ROUND(CAST(SUM(side.won) AS REAL) / COUNT(side.name), 2) ELSE 0 END AS winratio "
+                   "FROM players LEFT JOIN side ON side.name = players.name GROUP BY players.id")
+
+        db.execute("CREATE TEMP TABLE expected_league AS SELECT league_players.league_id, league_players.player_id, "
+                   "COUNT(side.name) AS gamesplayed, COALESCE(SUM(side.won), 0) AS gameswon, COUNT(side.name) - COALESCE(SUM(side.won), 0) AS gameslost, "
+                   "COALESCE(SUM(side.pf), 0) AS pf, COALESCE(SUM(side.pa), 0) AS pa, COALESCE(SUM(side.pf) - SUM(side.pa), 0) AS pd, "
+                   "3 * COALESCE(SUM(side.won), 0) AS points "
+                   "FROM league_players JOIN players ON players.id = league_players.player_id "
+                   "LEFT JOIN side ON side.name = players.name AND side.league_id = league_players.league_id "
+                   "GROUP BY league_players.league_id, league_players.player_id")
+
+        players = db.execute("SELECT players.id, players.name, {}, {} FROM players JOIN expected_players e ON e.player_id = players.id WHERE {}".format(
+            ", ".join("players." + column for column in PLAYER_COUNTERS),
+            ", ".join("e.{0} AS expected_{0}".format(column) for column in PLAYER_COUNTERS),
+            " OR ".join("players.{0} IS NOT e.{0}".format(column) for column in PLAYER_COUNTERS)))
+
+        leaguerows = db.execute("SELECT l.league_id, l.player_id, players.name, {}, {} FROM league_players l "
+                                "JOIN expected_league e ON e.league_id = l.league_id AND e.player_id = l.player_id "
+                                "JOIN players ON players.id = l.player_id WHERE {}".format(
+            ", ".join("l." + column for column in LEAGUE_COUNTERS),
+            ", ".join("e.{0} AS expected_{0}".format(column) for column in LEAGUE_COUNTERS),
+            " OR ".join("l.{0} IS NOT e.{0}".format(column) for column in LEAGUE_COUNTERS)))
+
+        strays = db.execute("SELECT side.league_id, side.name, COUNT(*) AS results FROM side "
+                            "LEFT JOIN players ON players.name = side.name "
+                            "LEFT JOIN league_players l ON l.league_id = side.league_id AND l.player_id = players.id "
+                            "WHERE l.player_id IS NULL GROUP BY side.league_id, side.name")
+
+        if repair:
+            db.execute("UPDATE players SET ({0}) = (SELECT {0} FROM expected_players e WHERE e.player_id = players.id) "
+                       "WHERE id IN (SELECT p.id FROM players p JOIN expected_players e ON e.player_id = p.id WHERE {1})".format(
+                           ", ".join(PLAYER_COUNTERS), " OR ".join("p.{0} IS NOT e.{0}".format(column) for column in PLAYER_COUNTERS)))
+            db.execute("UPDATE league_players SET ({0}) = (SELECT {0} FROM expected_league e WHERE e.league_id = league_players.league_id "
+                       "AND e.player_id = league_players.player_id) WHERE (league_id, player_id) IN "
+                       "(SELECT l.league_id, l.player_id FROM league_players l JOIN expected_league e ON e.league_id = l.league_id "
+                       "AND e.player_id = l.player_id WHERE {1})".format(", ".join(LEAGUE_COUNTERS),
+                                                                         " OR ".join("l.{0} IS NOT e.{0}".format(column) for column in LEAGUE_COUNTERS)))
+            db.executemany("UPDATE leagues SET version = version + 1 WHERE id = ?", [(league,) for league in {row["league_id"] for row in leaguerows}])
+
+        for table in ["side", "expected_players", "expected_league"]:
+            db.execute("DROP TABLE temp.{}".format(table))
+
+    return players, leaguerows, strays
+
+
+def read_matches(text, filename=""):
+    """Parse a csv or json list of matches into dicts keyed by RESULT_COLUMNS."""
+    if filename.lower().endswith(".json") or text.lstrip().startswith("["):
+        matches = json.loads(text)
+        if not isinstance(matches, list) or not all(isinstance(match, dict) for match in matches):
+            raise ValueError("json must be a list of matches")
+        return matches
+
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+def import_matches(db, matches, userid=None):
+    """Validate a batch of matches and record them in one transaction.
+
+    One job is queued per league in the batch to apply them and each match
+    is logged as recorded by userid. Returns a list of errors, in which case
+    nothing is written.
+    """
+    errors = []
+    rows = []
+
+    # Players entered in each league, used to check every match
+    rosters = {str(row["id"]): set() for row in db.execute("SELECT id FROM leagues")}
+    for row in db.execute("SELECT league_id, players.name FROM league_players JOIN players ON players.id = league_players.player_id"):
+        rosters[str(row["league_id"])].add(row["name"])
+
+    for n, match in enumerate(matches, 1):
+        leagueid = str(match.get("league_id") or "").strip()
+        player1 = str(match.get("player1") or "").strip()
+        player2 = str(match.get("player2") or "").strip()
+        date = str(match.get("date") or "").strip()
+
+        try:
+            p1sets = int(match.get("p1set"))
+            p2sets = int(match.get("p2set"))
+            games = [(game_score(match.get("p1g" + str(g))), game_score(match.get("p2g" + str(g)))) for g in range(1, 6)]
+        except (TypeError, ValueError):
+            errors.append("match {}: scores must be whole numbers".format(n))
+            continue
+
+        if leagueid not in rosters:
+            errors.append("match {}: no league with id {}".format(n, leagueid))
+            continue
+
+        if player1 not in rosters[leagueid] or player2 not in rosters[leagueid]:
+            errors.append("match {}: both players must be in league {}".format(n, leagueid))
+            continue
+
+        if player1 == player2:
+            errors.append("match {}: cannot play a match with one player".format(n))
+            continue
+
+        error = validate_match(p1sets, p2sets, games, date)
+        if error:
+            errors.append("match {}: {}".format(n, error))
+            continue
+
+        rows.append([leagueid, date, player1, player2, p1sets, p2sets] + [score for game in games for score in game])
+
+    if errors:
+        return errors
+
+    leagueids = sorted({row[0] for row in rows})
+    with db.transaction():
+        last = db.execute("SELECT COALESCE(MAX(id), 0) AS id FROM results")[0]["id"]
+        db.executemany("INSERT INTO results ({}, applied) VALUES ({}, 0)".format(", ".join(RESULT_COLUMNS), ", ".join("?" * len(RESULT_COLUMNS))), rows)
+        log_events(db, "record", userid, "id > ?", last)
+        db.executemany("UPDATE leagues SET version = version + 1 WHERE id = ?", [(leagueid,) for leagueid in leagueids])
+        for leagueid in leagueids:
+            enqueue(db, APPLY_RESULTS, leagueid)
+
+    return []
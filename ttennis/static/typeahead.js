@@ -0,0 +1,18 @@
+// Suggest player names from /players/search as they are typed into inputs marked data-typeahead
+$(function() {
+    var timer;
+    $("input[data-typeahead]").on("focus input", function() {
+        var input = $(this);
+        clearTimeout(timer);
+
+        // Wait for a pause in typing so each keystroke is not a request
+        timer = setTimeout(function() {
+            $.getJSON("/players/search", {q: input.val(), league: input.data("league") || ""}, function(names) {
+                var list = $("#" + input.attr("list")).empty();
+                names.forEach(function(name) {
+                    $("<option>").attr("value", name).appendTo(list);
+                });
+            });
+        }, 150);
+    });
+});